@@ -0,0 +1,355 @@
+"""
+ReAct agent mode, ported from the Agent / agent_loop of IA_Sahtech.ipynb.
+
+Unlike the notebook, several independent actions requested in one step run
+concurrently, tool results are memoized per request and across requests (with a
+TTL), and the loop is capped both in iterations and in wall time. Every run
+returns stats: LLM round trips, per-step latency and tool call counts.
+
+Tools work on the user_data / product_data of the request; get_user_profile and
+get_product_data only resolve the ids present in the request.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from food_terms import ALLERGEN_MATCHERS, parse_number
+from profile_canonicalization import ALLERGY_SYNONYMS, CONDITION_SYNONYMS, canonical_terms, normalize_term
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+AGENT_MAX_ITERATIONS = int(os.environ.get("AGENT_MAX_ITERATIONS", 5))
+AGENT_MAX_SECONDS = float(os.environ.get("AGENT_MAX_SECONDS", 20))
+AGENT_TOOL_CACHE_TTL = float(os.environ.get("AGENT_TOOL_CACHE_TTL", 600))
+AGENT_MODEL = "llama-3.3-70b-versatile"
+
+AGENT_SYSTEM_PROMPT = """
+You are an AI agent acting as a virtual nutritionist or doctor within the Sahtech health application.
+
+Your purpose is to help users determine whether scanned food products are safe and suitable for them, based on their health profile.
+
+You operate in a loop using the ReAct framework:
+Thought → Action → PAUSE → Observation
+At the end of the loop, output your final recommendation as the Answer.
+
+Behavior:
+- Think like a smart and responsible medical expert
+- Be empathetic and clear – users aren't doctors
+- Always explain your reasoning step by step
+- If a product is not suitable, clearly explain why it is harmful based on the user's health profile
+
+Available Actions:
+- get_product_data(barcode): Retrieve product details (ingredients, additives, scores)
+- get_user_profile(user_id): Retrieve health profile
+- compare_product_with_user(profile, product): Analyze compatibility
+- detailed_product_report(product): Explain nutrition, additives, ingredients
+
+Format:
+Thought: <your reasoning>
+Action: <tool>(<argument>)
+PAUSE
+
+You may request several independent actions in the same step, one "Action:" line each,
+before a single PAUSE. They are run together and you get one "Observation:" per action.
+
+When you are confident, answer with:
+Answer: <indicator> - <explanation in French>
+
+The indicator must be one of:
+- "✓ Recommended" - if the product appears suitable for the user
+- "⚠ Consume with caution" - if the user should be careful with this product
+- "× Avoid" - if the product is likely not suitable for the user's health profile
+
+Keep the answer concise but informative, focused on the health implications.
+""".strip()
+
+ACTION_PATTERN = re.compile(r"^\s*\**Action\**\s*:\s*\**([a-z_]+)\s*\((.*?)\)?\s*\**\s*$", re.IGNORECASE | re.MULTILINE)
+ANSWER_PATTERN = re.compile(r"\**(?:Answer|Réponse|Reponse)\**\s*:\s*", re.IGNORECASE)
+
+# Thresholds per 100g
+DIABETES_SUGAR_MAX_G = 5.0
+HYPERTENSION_SALT_MAX_G = 1.5
+ANEMIA_IRON_MIN_MG = 2.0
+
+
+def _contains_any(ingredients, group) -> list:
+    matcher = ALLERGEN_MATCHERS[group]
+    return [ingredient for ingredient in ingredients or [] if matcher.search(normalize_term(ingredient))]
+
+
+# Tools
+
+def compare_product_with_user(profile: dict, product: dict) -> dict:
+    """Analyze if the product is suitable for the user"""
+    result = {
+        "suitable": True,
+        "issues": []
+    }
+    conditions = canonical_terms(profile.get("health_conditions"), CONDITION_SYNONYMS)
+    allergies = canonical_terms(profile.get("allergies"), ALLERGY_SYNONYMS)
+    ingredients = product.get("ingredients") or []
+    nutrition = product.get("nutrition_values") or {}
+
+    if "milk" in allergies or "lactose" in allergies:
+        found = _contains_any(ingredients, "milk")
+        if found:
+            result["suitable"] = False
+            result["issues"].append(f"Product contains milk ingredients ({', '.join(found)}), dangerous for users with milk allergy or lactose intolerance.")
+
+    if "peanuts" in allergies:
+        found = _contains_any(ingredients, "peanuts")
+        if found:
+            result["suitable"] = False
+            result["issues"].append(f"Product contains peanuts ({', '.join(found)}), dangerous for users with peanut allergy.")
+
+    if "gluten" in allergies or "celiac_disease" in conditions:
+        found = _contains_any(ingredients, "gluten")
+        if found:
+            result["suitable"] = False
+            result["issues"].append(f"Product contains gluten ({', '.join(found)}), dangerous for users with celiac disease or gluten allergy.")
+
+    if any(condition.startswith("diabetes") for condition in conditions):
+        sugar = parse_number(nutrition.get("sugar", nutrition.get("sugars")))
+        if sugar is not None and sugar > DIABETES_SUGAR_MAX_G:
+            result["suitable"] = False
+            result["issues"].append(f"Product has high sugar content ({sugar}g), not suitable for users with diabetes.")
+
+    if "hypertension" in conditions:
+        salt = parse_number(nutrition.get("salt"))
+        if salt is None:
+            sodium = parse_number(nutrition.get("sodium"))
+            if sodium is not None:
+                salt = sodium * 2.5
+        if salt is not None and salt > HYPERTENSION_SALT_MAX_G:
+            result["suitable"] = False
+            result["issues"].append(f"Product has high salt content ({round(salt, 2)}g), not suitable for users with hypertension.")
+
+    if "anemia" in conditions:
+        # Iron deficiency anemia => the user needs iron-rich food
+        iron = parse_number(nutrition.get("iron"))
+        if iron is None:
+            result["issues"].append("Product does not provide iron information; may not help users with iron deficiency anemia.")
+        elif iron < ANEMIA_IRON_MIN_MG:
+            result["issues"].append("Product is low in iron, not helpful for users with iron deficiency anemia.")
+
+    return result
+
+
+def detailed_product_report(product: dict) -> str:
+    """Returns a human-readable summary of the product's nutritional content and ingredients"""
+    return (
+        f"Product: {product.get('name')} ({product.get('brand') or 'Unknown'})\n"
+        f"Category: {product.get('category') or 'Unknown'}\n"
+        f"Ingredients: {', '.join(product.get('ingredients') or []) or 'None'}\n"
+        f"Additives: {', '.join(product.get('additives') or []) or 'None'}\n"
+        f"Nutrition Values: {product.get('nutrition_values') or {}}\n"
+        f"Nutri-Score: {product.get('nutri_score') or 'N/A'}"
+    )
+
+
+class TTLCache:
+    """Small thread-safe cache whose entries expire after `ttl` seconds"""
+
+    def __init__(self, ttl: float, max_entries: int = 5000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                # Drop expired entries first, then the oldest ones
+                now = time.monotonic()
+                for k in [k for k, (expires, _) in self._entries.items() if expires < now]:
+                    del self._entries[k]
+                while len(self._entries) >= self.max_entries:
+                    del self._entries[next(iter(self._entries))]
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+
+
+# Shared across requests
+tool_cache = TTLCache(AGENT_TOOL_CACHE_TTL)
+
+
+def _digest(data) -> str:
+    raw = json.dumps(data, sort_keys=True, ensure_ascii=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+class AgentRun:
+    """One agent conversation for one (user, product) request"""
+
+    def __init__(self, client, profile: dict, product: dict, max_iterations: int, max_seconds: float):
+        self.client = client
+        self.profile = profile
+        self.product = product
+        self.max_iterations = max_iterations
+        self.max_seconds = max_seconds
+        self.messages = [{"role": "system", "content": AGENT_SYSTEM_PROMPT}]
+        self._memo = {}
+        self._profile_digest = _digest(profile)
+        self._product_digest = _digest(product)
+        self.stats = {
+            "round_trips": 0,
+            "steps": [],
+            "tool_calls": 0,
+            "tool_cache_hits": 0,
+            "stop_reason": None,
+            "duration_ms": None,
+        }
+
+    # Tool dispatch
+
+    def _tool_key(self, tool: str, arg: str):
+        """Memo key for a tool call, or None if the tool is unknown"""
+        if tool == "get_product_data":
+            return (tool, arg, self._product_digest)
+        if tool == "get_user_profile":
+            return (tool, arg, self._profile_digest)
+        if tool == "compare_product_with_user":
+            return (tool, self._profile_digest, self._product_digest)
+        if tool == "detailed_product_report":
+            return (tool, self._product_digest)
+        return None
+
+    def _call_tool(self, tool: str, arg: str):
+        if tool == "get_product_data":
+            if arg and self.product.get("barcode") and arg != self.product.get("barcode"):
+                raise ValueError(f"Product with barcode {arg} not found.")
+            return self.product
+        if tool == "get_user_profile":
+            if arg and arg not in ("profile", self.profile.get("user_id")):
+                raise ValueError(f"User profile with ID {arg} not found.")
+            return {k: v for k, v in self.profile.items() if k != "user_id"}
+        if tool == "compare_product_with_user":
+            return compare_product_with_user(self.profile, self.product)
+        if tool == "detailed_product_report":
+            return detailed_product_report(self.product)
+        raise ValueError("Tool not found")
+
+    async def _run_action(self, tool: str, arg: str) -> str:
+        key = self._tool_key(tool, arg)
+        if key is None:
+            return f"Observation: Tool {tool} not found"
+
+        # Same call twice in one request (or in one step) runs once
+        task = self._memo.get(key)
+        if task is None:
+            cached = tool_cache.get(key)
+            if cached is not None:
+                self.stats["tool_cache_hits"] += 1
+                return f"Observation ({tool}): {cached}"
+            self.stats["tool_calls"] += 1
+            task = asyncio.ensure_future(asyncio.to_thread(self._call_tool, tool, arg))
+            self._memo[key] = task
+        else:
+            self.stats["tool_cache_hits"] += 1
+
+        try:
+            result = await task
+        except Exception as e:
+            return f"Observation ({tool}): Tool execution failed - {e}"
+        tool_cache.put(key, result)
+        return f"Observation ({tool}): {result}"
+
+    # LLM
+
+    def _complete(self) -> str:
+        completion = self.client.chat.completions.create(
+            messages=self.messages,
+            model=AGENT_MODEL,
+            temperature=0.3,
+            max_tokens=500,
+        )
+        return completion.choices[0].message.content
+
+    async def run(self):
+        """Run the loop. Returns the final answer text, or None if no answer was reached"""
+        start = time.perf_counter()
+        deadline = start + self.max_seconds
+        prompt = (
+            f"A user scanned a product (barcode {self.product.get('barcode') or 'unknown'}) "
+            f"and their user id is {self.profile.get('user_id')}. Can they consume this product?"
+        )
+        answer = None
+        try:
+            for iteration in range(1, self.max_iterations + 1):
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self.stats["stop_reason"] = "time_limit"
+                    break
+
+                step_start = time.perf_counter()
+                self.messages.append({"role": "user", "content": prompt})
+                with span("llm_call"):
+                    result = await asyncio.wait_for(asyncio.to_thread(self._complete), timeout=remaining)
+                self.stats["round_trips"] += 1
+                self.messages.append({"role": "assistant", "content": result})
+                llm_ms = (time.perf_counter() - step_start) * 1000
+
+                actions = [(m.group(1), m.group(2).strip().strip('"').strip("'")) for m in ACTION_PATTERN.finditer(result)]
+                answer_match = ANSWER_PATTERN.search(result)
+                step = {"iteration": iteration, "llm_ms": round(llm_ms, 1), "actions": [tool for tool, _ in actions]}
+
+                if answer_match and not actions:
+                    answer = result[answer_match.end():].strip()
+                    self.stats["steps"].append(step)
+                    self.stats["stop_reason"] = "answer"
+                    break
+
+                if actions:
+                    tools_start = time.perf_counter()
+                    with span("agent_tools"):
+                        observations = await asyncio.gather(*(self._run_action(tool, arg) for tool, arg in actions))
+                    step["tools_ms"] = round((time.perf_counter() - tools_start) * 1000, 1)
+                    prompt = "\n".join(observations)
+                else:
+                    prompt = "Observation: No valid action found. Use an Action or give your Answer."
+                self.stats["steps"].append(step)
+            else:
+                self.stats["stop_reason"] = "max_iterations"
+        except asyncio.TimeoutError:
+            self.stats["stop_reason"] = "time_limit"
+        except Exception as e:
+            logger.error("Agent loop failed: %s", e)
+            self.stats["stop_reason"] = "error"
+        finally:
+            self.stats["duration_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        return answer
+
+
+async def run_agent(client, profile: dict, product: dict, max_iterations: int = AGENT_MAX_ITERATIONS, max_seconds: float = AGENT_MAX_SECONDS):
+    """
+    Run the ReAct agent for one user/product pair
+
+    Args:
+        client: Groq client
+        profile (dict): user_data of the request
+        product (dict): product_data of the request
+        max_iterations (int): Hard cap on LLM round trips
+        max_seconds (float): Hard cap on wall time
+
+    Returns:
+        tuple: (answer text or None, stats dict)
+    """
+    agent = AgentRun(client, profile, product, max_iterations, max_seconds)
+    answer = await agent.run()
+    return answer, agent.stats
@@ -0,0 +1,269 @@
+"""
+Healthier alternatives ranking over a local product catalog, without any LLM call.
+
+The catalog (PRODUCT_CATALOG_PATH, JSON list or JSON lines of product_data objects)
+is loaded once into a column-oriented layout per category: a float32 matrix of
+nutrition values per 100g scaled by reference amounts, a Nutri-Score column and
+one boolean column per allergen group. Ranking a request is then one matrix-vector
+product with weights derived from the user's conditions and objectives, an
+allergen mask and an argpartition for the top-k.
+"""
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from food_terms import ALLERGEN_MATCHERS, TermMatcher, parse_number
+from profile_canonicalization import (
+    ALLERGY_SYNONYMS,
+    CONDITION_SYNONYMS,
+    OBJECTIVE_SYNONYMS,
+    canonical_terms,
+    normalize_term,
+)
+
+logger = logging.getLogger(__name__)
+
+# Column order of the nutrition matrix and the amount per 100g each value is scaled by
+NUTRIENTS = ["calories", "sugar", "fat", "saturated_fat", "salt", "fiber", "protein", "carbs"]
+NUTRIENT_SCALES = np.array([500.0, 22.5, 17.5, 5.0, 1.5, 6.0, 20.0, 50.0], dtype=np.float32)
+
+NUTRIENT_ALIASES = {
+    "calories": "calories",
+    "energy": "calories",
+    "energie": "calories",
+    "kcal": "calories",
+    "sugar": "sugar",
+    "sugars": "sugar",
+    "sucre": "sugar",
+    "sucres": "sugar",
+    "fat": "fat",
+    "fats": "fat",
+    "graisses": "fat",
+    "lipides": "fat",
+    "matieres grasses": "fat",
+    "saturated fat": "saturated_fat",
+    "saturated fats": "saturated_fat",
+    "acides gras satures": "saturated_fat",
+    "salt": "salt",
+    "sel": "salt",
+    "fiber": "fiber",
+    "fibers": "fiber",
+    "fibre": "fiber",
+    "fibres": "fiber",
+    "protein": "protein",
+    "proteins": "protein",
+    "proteines": "protein",
+    "carbs": "carbs",
+    "carbohydrates": "carbs",
+    "glucides": "carbs",
+}
+
+NUTRI_SCORE_VALUES = {"A": 0.0, "B": 1.0, "C": 2.0, "D": 3.0, "E": 4.0}
+
+# Lower score is healthier. Fiber and protein have negative weights: more is better.
+BASE_WEIGHTS = {"calories": 1.0, "sugar": 1.0, "fat": 0.5, "saturated_fat": 1.0, "salt": 1.0, "fiber": -0.5, "protein": -0.3, "carbs": 0.0}
+NUTRI_SCORE_WEIGHT = 1.0
+
+# Extra weight added per condition / objective
+CONDITION_WEIGHTS = {
+    "diabetes": {"sugar": 3.0, "carbs": 1.0},
+    "diabetes_type_1": {"sugar": 3.0, "carbs": 1.0},
+    "diabetes_type_2": {"sugar": 3.0, "carbs": 1.0},
+    "hypertension": {"salt": 3.0},
+    "high_cholesterol": {"saturated_fat": 3.0, "fat": 1.0},
+    "obesity": {"calories": 2.0, "fat": 1.0, "sugar": 1.0},
+    "kidney_disease": {"salt": 2.0, "protein": 0.8},
+}
+OBJECTIVE_WEIGHTS = {
+    "weight_loss": {"calories": 2.0, "fat": 1.0, "sugar": 1.0},
+    "weight_gain": {"calories": -1.5},
+    "muscle_gain": {"protein": -2.0},
+    "healthy_eating": {"fiber": -0.5},
+}
+
+# One boolean column per canonical allergy (see food_terms.ALLERGEN_MATCHERS)
+ALLERGEN_GROUPS = ALLERGEN_MATCHERS
+# Per category, columns kept for allergies outside ALLERGEN_GROUPS
+MAX_TERM_MASKS = 64
+
+
+def nutrition_vector(nutrition_values: dict) -> np.ndarray:
+    """Map a nutrition_values dict to the NUTRIENTS columns (NaN where missing), unscaled"""
+    vector = np.full(len(NUTRIENTS), np.nan, dtype=np.float32)
+    sodium = None
+    for key, value in (nutrition_values or {}).items():
+        name = normalize_term(key)
+        if name == "sodium":
+            sodium = parse_number(value)
+            continue
+        column = NUTRIENT_ALIASES.get(name)
+        if column is None:
+            continue
+        number = parse_number(value)
+        if number is not None:
+            vector[NUTRIENTS.index(column)] = number
+    salt_index = NUTRIENTS.index("salt")
+    if np.isnan(vector[salt_index]) and sodium is not None:
+        vector[salt_index] = sodium * 2.5
+    return vector
+
+
+def user_weights(user_data) -> np.ndarray:
+    """Weight vector over NUTRIENTS for this user's conditions and objectives"""
+    weights = dict(BASE_WEIGHTS)
+    conditions = canonical_terms(user_data.health_conditions, CONDITION_SYNONYMS)
+    objectives = canonical_terms(user_data.objectives, OBJECTIVE_SYNONYMS)
+    for extra in [CONDITION_WEIGHTS.get(c, {}) for c in conditions] + [OBJECTIVE_WEIGHTS.get(o, {}) for o in objectives]:
+        for nutrient, weight in extra.items():
+            weights[nutrient] += weight
+    return np.array([weights[n] for n in NUTRIENTS], dtype=np.float32)
+
+
+class CategoryColumns:
+    """Column-oriented nutrition data of one category"""
+
+    def __init__(self, products: list):
+        self.size = len(products)
+        self.barcodes = np.array([str(p.get("barcode") or "") for p in products], dtype=object)
+        self.names = [p.get("name") for p in products]
+        self.brands = [p.get("brand") for p in products]
+        self.nutri_scores = [str(p.get("nutri_score") or "").upper() or None for p in products]
+
+        raw = np.vstack([nutrition_vector(p.get("nutrition_values")) for p in products])
+        # Missing values are filled with the category median, so they neither help nor hurt a product
+        medians = np.nanmedian(np.where(np.isnan(raw).all(axis=0), 0.0, raw), axis=0) if self.size else np.zeros(len(NUTRIENTS))
+        self.medians = np.nan_to_num(medians).astype(np.float32)
+        filled = np.where(np.isnan(raw), self.medians, raw)
+        self.raw = raw
+        self.scaled = (filled / NUTRIENT_SCALES).astype(np.float32)
+
+        nutri = np.array([NUTRI_SCORE_VALUES.get(score, np.nan) for score in self.nutri_scores], dtype=np.float32)
+        self.nutri = np.where(np.isnan(nutri), 2.0, nutri).astype(np.float32)
+
+        # Accent-free ingredient text per product, for the allergen columns and allergies without one
+        self.ingredient_text = [" | ".join(normalize_term(ing) for ing in (p.get("ingredients") or [])) for p in products]
+        self.allergens = {}
+        for group, matcher in ALLERGEN_GROUPS.items():
+            self.allergens[group] = self.mentions(matcher)
+        self.index = {barcode: i for i, barcode in enumerate(self.barcodes) if barcode}
+        # Columns of allergies without a word list, computed on first use (see term_mask)
+        self._term_masks = {}
+
+    def mentions(self, matcher: TermMatcher) -> np.ndarray:
+        """Boolean column: the product's ingredients mention one of the matcher's words"""
+        return np.fromiter((matcher.search(text) for text in self.ingredient_text), dtype=bool, count=self.size)
+
+    def term_mask(self, term: str) -> np.ndarray:
+        """Boolean column for an allergy without a word list, memoized so only its first request scans the category"""
+        mask = self._term_masks.get(term)
+        if mask is None:
+            mask = self.mentions(TermMatcher([term]))
+            if len(self._term_masks) >= MAX_TERM_MASKS:
+                # Allergies are free text: forget the oldest term rather than grow without bound
+                self._term_masks.pop(next(iter(self._term_masks)), None)
+            self._term_masks[term] = mask
+        return mask
+
+    def scores(self, weights: np.ndarray) -> np.ndarray:
+        return self.scaled @ weights + NUTRI_SCORE_WEIGHT * self.nutri
+
+
+class ProductCatalog:
+    def __init__(self):
+        self.categories = {}
+        self.product_count = 0
+        self.loaded_at = None
+        self.source = None
+
+    def load(self, path: str) -> int:
+        """
+        Load the catalog and precompute the per-category columns
+
+        Args:
+            path (str): JSON list or JSON lines file of product_data objects
+
+        Returns:
+            int: Number of products loaded
+        """
+        if not path or not os.path.exists(path):
+            logger.info("No product catalog found at %s, alternatives are disabled", path)
+            return 0
+        start = time.perf_counter()
+        by_category = {}
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read().strip()
+        records = json.loads(text) if text.startswith("[") else [json.loads(line) for line in text.splitlines() if line.strip()]
+        for product in records:
+            category = normalize_term(product.get("category") or "")
+            if category:
+                by_category.setdefault(category, []).append(product)
+
+        self.categories = {category: CategoryColumns(products) for category, products in by_category.items()}
+        self.product_count = sum(columns.size for columns in self.categories.values())
+        self.loaded_at = time.time()
+        self.source = path
+        logger.info("Loaded %d products in %d categories from %s in %.1fs", self.product_count, len(self.categories), path, time.perf_counter() - start)
+        return self.product_count
+
+    def rank(self, user_data, product_data, top_k: int = 5) -> dict:
+        """Top-k products of the same category that score better than this product for this user"""
+        start = time.perf_counter()
+        category = normalize_term(product_data.category or "")
+        columns = self.categories.get(category)
+        if columns is None:
+            return {"category": category, "alternatives": [], "reason": "category not in catalog"}
+
+        weights = user_weights(user_data)
+        scores = columns.scores(weights)
+
+        # Score of the scanned product: its catalog row if we have it, else computed from the request
+        row = columns.index.get(product_data.barcode or "")
+        if row is not None:
+            product_score = float(scores[row])
+        else:
+            vector = nutrition_vector(product_data.nutrition_values)
+            vector = np.where(np.isnan(vector), columns.medians, vector)
+            nutri = NUTRI_SCORE_VALUES.get((product_data.nutri_score or "").upper(), 2.0)
+            product_score = float((vector / NUTRIENT_SCALES) @ weights + NUTRI_SCORE_WEIGHT * nutri)
+
+        mask = scores < product_score
+        if row is not None:
+            mask[row] = False
+        text_matched = []
+        for allergy in canonical_terms(user_data.allergies, ALLERGY_SYNONYMS):
+            if allergy in columns.allergens:
+                mask &= ~columns.allergens[allergy]
+            else:
+                # Allergy we have no word list for: exclude products naming it in their ingredients
+                text_matched.append(allergy)
+                mask &= ~columns.term_mask(allergy.replace("_", " "))
+
+        candidates = np.flatnonzero(mask)
+        if candidates.size > top_k:
+            candidates = candidates[np.argpartition(scores[candidates], top_k)[:top_k]]
+        candidates = candidates[np.argsort(scores[candidates])]
+
+        alternatives = [
+            {
+                "barcode": columns.barcodes[i],
+                "name": columns.names[i],
+                "brand": columns.brands[i],
+                "nutri_score": columns.nutri_scores[i],
+                "score": round(float(scores[i]), 3),
+                "improvement": round(product_score - float(scores[i]), 3),
+                "nutrition_values": {n: round(float(v), 2) for n, v in zip(NUTRIENTS, columns.raw[i]) if not np.isnan(v)},
+            }
+            for i in candidates
+        ]
+        return {
+            "category": category,
+            "product_score": round(product_score, 3),
+            "candidates_in_category": columns.size,
+            "alternatives": alternatives,
+            # Only filtered by the allergy's own name, the client may want to double check these
+            "text_matched_allergies": text_matched,
+            "ranking_ms": round((time.perf_counter() - start) * 1000, 3),
+        }
@@ -0,0 +1,287 @@
+"""
+Streaming bulk ingest and msgpack content negotiation.
+
+Bulk endpoints read newline-delimited JSON (application/x-ndjson) or a stream of
+msgpack objects (application/msgpack) incrementally, run a handler per record with
+bounded concurrency, and stream results back as NDJSON in input order:
+
+    {"index": 0, "ok": true, "result": {...}}
+    {"index": 1, "ok": false, "error": "..."}
+
+Memory is bounded by the reorder window: at most `window` records are parsed and
+in flight at once; reading the request body pauses until the oldest one is written.
+
+MsgpackMiddleware lets the regular JSON endpoints accept msgpack bodies
+(Content-Type: application/msgpack) and return msgpack (Accept: application/msgpack).
+"""
+import asyncio
+import json
+import logging
+import os
+
+import msgpack
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import StreamingResponse
+
+logger = logging.getLogger(__name__)
+
+BULK_CONCURRENCY = int(os.environ.get("BULK_CONCURRENCY", 8))
+BULK_WINDOW = int(os.environ.get("BULK_WINDOW", 64))
+BULK_MAX_RECORD_BYTES = int(os.environ.get("BULK_MAX_RECORD_BYTES", 1024 * 1024))
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack")
+NDJSON_TYPE = "application/x-ndjson"
+
+
+def is_msgpack(content_type: str) -> bool:
+    return (content_type or "").split(";")[0].strip().lower() in MSGPACK_TYPES
+
+
+class RecordError:
+    """Placeholder for a record that could not be decoded; reported at its index"""
+
+    def __init__(self, message: str):
+        self.message = message
+
+
+async def iter_ndjson(chunks):
+    buffer = b""
+    # Set while dropping the rest of an oversized record, up to its newline
+    skipping = False
+    async for chunk in chunks:
+        buffer += chunk
+        while True:
+            newline = buffer.find(b"\n")
+            if newline < 0:
+                break
+            line, buffer = buffer[:newline], buffer[newline + 1:]
+            if skipping:
+                skipping = False
+                continue
+            if len(line) > BULK_MAX_RECORD_BYTES:
+                yield RecordError(f"Record larger than {BULK_MAX_RECORD_BYTES} bytes")
+            elif line.strip():
+                yield _decode_json_line(line)
+        if len(buffer) > BULK_MAX_RECORD_BYTES:
+            if not skipping:
+                yield RecordError(f"Record larger than {BULK_MAX_RECORD_BYTES} bytes")
+                skipping = True
+            buffer = b""
+    if buffer.strip() and not skipping:
+        yield _decode_json_line(buffer)
+
+
+def _decode_json_line(line: bytes):
+    try:
+        return json.loads(line)
+    except Exception as e:
+        return RecordError(f"Invalid JSON: {e}")
+
+
+async def iter_msgpack(chunks):
+    unpacker = msgpack.Unpacker(raw=False, max_buffer_size=BULK_MAX_RECORD_BYTES * 2)
+    async for chunk in chunks:
+        try:
+            unpacker.feed(chunk)
+        except msgpack.BufferFull:
+            yield RecordError(f"Record larger than {BULK_MAX_RECORD_BYTES} bytes")
+            return
+        try:
+            for record in unpacker:
+                yield record
+        except Exception as e:
+            # The stream can't be resynchronized after a corrupt msgpack object
+            yield RecordError(f"Invalid msgpack: {e}")
+            return
+
+
+def iter_records(request):
+    """Decode the request body as a stream of records, according to its Content-Type"""
+    if is_msgpack(request.headers.get("content-type")):
+        return iter_msgpack(request.stream())
+    return iter_ndjson(request.stream())
+
+
+async def stream_results(records, handler, concurrency: int = BULK_CONCURRENCY, window: int = BULK_WINDOW):
+    """
+    Run `handler` on each record and yield NDJSON result lines in input order
+
+    Args:
+        records: async iterator of decoded records
+        handler: async function taking one record and returning a JSON-serializable result
+        concurrency (int): Max records processed at the same time
+        window (int): Max records read ahead of the last one written
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    pending = asyncio.Queue(maxsize=window)
+
+    async def run_one(record):
+        if isinstance(record, RecordError):
+            raise ValueError(record.message)
+        async with semaphore:
+            return await handler(record)
+
+    async def produce():
+        try:
+            async for record in records:
+                await pending.put(asyncio.ensure_future(run_one(record)))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Error reading bulk request body: %s", e)
+            await pending.put(asyncio.ensure_future(run_one(RecordError(f"Error reading request body: {e}"))))
+        await pending.put(None)
+
+    producer = asyncio.ensure_future(produce())
+    index = 0
+    succeeded = 0
+    try:
+        while True:
+            task = await pending.get()
+            if task is None:
+                break
+            try:
+                line = {"index": index, "ok": True, "result": await task}
+                succeeded += 1
+            except Exception as e:
+                line = {"index": index, "ok": False, "error": str(e)}
+            yield json.dumps(line, ensure_ascii=False, default=str) + "\n"
+            index += 1
+        logger.info("Bulk request finished: %d records, %d failed", index, index - succeeded, extra={"event": "bulk.finished"})
+    finally:
+        # Client went away or the stream ended: don't leave work running
+        producer.cancel()
+        while not pending.empty():
+            task = pending.get_nowait()
+            if task is not None:
+                task.cancel()
+
+
+class NDJSONStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse for bulk endpoints.
+
+    The stock StreamingResponse consumes receive() to watch for client disconnects,
+    which would swallow the request body we are still reading while results stream
+    out. A disconnect still surfaces as ClientDisconnect from request.stream() or as
+    a failed send.
+    """
+
+    media_type = NDJSON_TYPE
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
+class PrefixDispatchMiddleware:
+    """
+    Send requests under `prefix` straight to `target`, bypassing the rest of the middleware stack.
+
+    Must be registered last (outermost). Used for the bulk endpoints: each
+    @app.middleware("http") layer re-streams the response through a StreamingResponse
+    that also consumes receive(), so a request body can't be read while the
+    response is streaming through them.
+    """
+
+    def __init__(self, app, prefix: str, target):
+        self.app = app
+        self.prefix = prefix
+        self.target = target
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith(self.prefix):
+            await self.target(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+
+class MsgpackMiddleware:
+    """ASGI middleware translating msgpack request/response bodies to and from JSON"""
+
+    def __init__(self, app, skip_prefixes=("/bulk",)):
+        self.app = app
+        self.skip_prefixes = skip_prefixes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.skip_prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        msgpack_in = is_msgpack(headers.get("content-type"))
+        msgpack_out = any(t in headers.get("accept", "") for t in MSGPACK_TYPES)
+        if not msgpack_in and not msgpack_out:
+            await self.app(scope, receive, send)
+            return
+
+        if msgpack_in:
+            body = b""
+            more_body = True
+            while more_body:
+                message = await receive()
+                body += message.get("body", b"")
+                more_body = message.get("more_body", False)
+            try:
+                body = json.dumps(msgpack.unpackb(body, raw=False)).encode("utf-8")
+            except Exception as e:
+                await self._send_error(send, f"Invalid msgpack body: {e or type(e).__name__}")
+                return
+
+            scope = dict(scope)
+            request_headers = MutableHeaders(scope=scope)
+            request_headers["content-type"] = "application/json"
+            request_headers["content-length"] = str(len(body))
+            body_sent = False
+
+            async def receive_json():
+                nonlocal body_sent
+                if body_sent:
+                    return await receive()
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+        else:
+            receive_json = receive
+
+        if not msgpack_out:
+            await self.app(scope, receive_json, send)
+            return
+
+        start_message = None
+        passthrough = False
+        chunks = []
+
+        async def send_msgpack(message):
+            nonlocal start_message, passthrough
+            if message["type"] == "http.response.start":
+                if not Headers(raw=message["headers"]).get("content-type", "").startswith("application/json"):
+                    # Not JSON (e.g. plain text or a stream): pass through untouched
+                    passthrough = True
+                    await send(message)
+                else:
+                    start_message = message
+                return
+            if passthrough or message["type"] != "http.response.body":
+                await send(message)
+                return
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            packed = msgpack.packb(json.loads(b"".join(chunks) or b"null"), use_bin_type=True)
+            response_headers = MutableHeaders(raw=start_message["headers"])
+            response_headers["content-type"] = "application/msgpack"
+            response_headers["content-length"] = str(len(packed))
+            await send(start_message)
+            await send({"type": "http.response.body", "body": packed, "more_body": False})
+
+        await self.app(scope, receive_json, send_msgpack)
+
+    async def _send_error(self, send, detail: str):
+        body = json.dumps({"detail": detail}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 400,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body, "more_body": False})
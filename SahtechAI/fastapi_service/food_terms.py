@@ -0,0 +1,95 @@
+"""
+Ingredient vocabulary and value parsing shared by the agent tools and the alternatives ranking.
+
+ALLERGEN_WORDS maps every canonical allergy of profile_canonicalization.ALLERGY_SYNONYMS
+to the (accent-free, lowercase) words that reveal it in an ingredient list, and
+ALLERGEN_MATCHERS to a TermMatcher finding them on word boundaries ("ble" in
+"farine de ble" but not in "soluble").
+"""
+import re
+
+NUMBER_PATTERN = re.compile(r"[-+]?\d+(?:[.,]\d+)?")
+
+# Words match whole (plurals included, "noix" or "noisettes"); a trailing "*" marks a
+# prefix, for the words whose other forms share it ("anchov*": anchovy, anchovies)
+MILK_WORDS = ("milk", "lait", "laitier", "laitiere", "lactose", "lacto*", "cream", "creme", "butter", "buttermilk",
+              "beurre", "whey", "casein*", "fromage", "cheese")
+PEANUT_WORDS = ("peanut", "arachide", "cacahuete")
+GLUTEN_WORDS = ("gluten", "wheat", "ble", "orge", "barley", "seigle", "rye", "epeautre", "spelt")
+TREE_NUT_WORDS = ("noix", "noisette", "amande", "cajou", "pistache", "pecan", "macadamia", "nut", "hazelnut", "almond", "cashew", "pistachio")
+EGG_WORDS = ("oeuf", "egg", "albumine", "albumen", "lysozyme")
+SOY_WORDS = ("soja", "soy", "soya", "soybean")
+FISH_WORDS = ("poisson", "fish", "saumon", "salmon", "thon", "tuna", "cabillaud", "cod", "anchois", "anchov*", "sardine", "maquereau", "mackerel")
+SHELLFISH_WORDS = ("crustace", "crustacean", "shellfish", "crevette", "shrimp", "crabe", "crab", "homard", "lobster", "langoustine", "moule", "mussel", "huitre", "oyster")
+SESAME_WORDS = ("sesame", "tahini", "tahin")
+MUSTARD_WORDS = ("moutarde", "mustard")
+CELERY_WORDS = ("celeri", "celery", "celeriac")
+LUPIN_WORDS = ("lupin", "lupine")
+SULPHITE_WORDS = ("sulfite", "sulphite", "bisulfite", "disulfite", "metabisulfite", "anhydride sulfureux",
+                  "sulfur dioxide", "sulphur dioxide", "e220", "e221", "e222", "e223", "e224", "e226", "e227", "e228")
+
+ALLERGEN_WORDS = {
+    "milk": MILK_WORDS,
+    "lactose": MILK_WORDS,
+    "peanuts": PEANUT_WORDS,
+    "gluten": GLUTEN_WORDS,
+    "tree_nuts": TREE_NUT_WORDS,
+    "eggs": EGG_WORDS,
+    "soy": SOY_WORDS,
+    "fish": FISH_WORDS,
+    "shellfish": SHELLFISH_WORDS,
+    "sesame": SESAME_WORDS,
+    "mustard": MUSTARD_WORDS,
+    "celery": CELERY_WORDS,
+    "lupin": LUPIN_WORDS,
+    "sulphites": SULPHITE_WORDS,
+}
+
+# Phrases that contain one of the group's words without containing the allergen
+MILK_LOOKALIKES = ("beurre de cacao", "cocoa butter", "beurre de karite", "shea butter", "beurre de cacahuete", "peanut butter",
+                   "lait de coco", "coconut milk", "creme de coco", "coconut cream", "lait de soja", "soy milk",
+                   "lait d'amande", "almond milk", "lait d'avoine", "oat milk")
+GLUTEN_LOOKALIKES = ("sans gluten", "gluten free", "ble noir")
+TREE_NUT_LOOKALIKES = ("noix de coco", "noix de muscade", "noix de saint jacques")
+
+ALLERGEN_LOOKALIKES = {
+    "milk": MILK_LOOKALIKES,
+    "lactose": MILK_LOOKALIKES,
+    "gluten": GLUTEN_LOOKALIKES,
+    "tree_nuts": TREE_NUT_LOOKALIKES,
+}
+
+
+class TermMatcher:
+    """Finds words of a list in normalized (accent-free, lowercase) text, on word boundaries"""
+
+    def __init__(self, words, lookalikes=()):
+        whole = [re.escape(word) for word in words if not word.endswith("*")]
+        prefixes = [re.escape(word[:-1]) for word in words if word.endswith("*")]
+        alternatives = []
+        if whole:
+            alternatives.append(r"(?:%s)(?:s|x|es)?\b" % "|".join(whole))
+        if prefixes:
+            alternatives.append("(?:%s)" % "|".join(prefixes))
+        self.pattern = re.compile(r"\b(?:%s)" % "|".join(alternatives))
+        self.lookalikes = re.compile(r"\b(?:%s)\b" % "|".join(re.escape(phrase) for phrase in lookalikes)) if lookalikes else None
+
+    def search(self, text: str) -> bool:
+        if not self.pattern.search(text):
+            return False
+        if self.lookalikes is None:
+            return True
+        return self.pattern.search(self.lookalikes.sub(" | ", text)) is not None
+
+
+ALLERGEN_MATCHERS = {group: TermMatcher(words, ALLERGEN_LOOKALIKES.get(group, ())) for group, words in ALLERGEN_WORDS.items()}
+
+
+def parse_number(value):
+    """Extract the first number from values like 3.5, "3.5g" or "1.5% to 2.5%" """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = NUMBER_PATTERN.search(str(value))
+    return float(match.group(0).replace(",", ".")) if match else None
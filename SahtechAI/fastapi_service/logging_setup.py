@@ -0,0 +1,147 @@
+"""
+Non-blocking structured logging.
+
+Log calls on the request path only put the record on a queue; a QueueListener
+thread formats it (as JSON by default) and writes it to stderr. Messages are
+formatted lazily: use logger.info("... %s", value) rather than f-strings, so the
+string is only built in the listener thread, and not at all for dropped records.
+
+Environment variables:
+- LOG_LEVEL: root level (default INFO)
+- LOG_FORMAT: "json" (default) or "text"
+- LOG_SAMPLE_RATES: per-event sampling, e.g. "predict.received=0.1,predict.barcode=0.01".
+  Events are set with extra={"event": "..."}; WARNING and above are never sampled out.
+- LOG_PAYLOADS: "true" to log request payloads (off by default)
+- LOG_PAYLOAD_MAX_CHARS: payloads are truncated to this length (default 1000)
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from tracing import current_trace_id
+
+LOG_PAYLOADS = os.environ.get("LOG_PAYLOADS", "false").lower() in ("1", "true", "yes")
+LOG_PAYLOAD_MAX_CHARS = int(os.environ.get("LOG_PAYLOAD_MAX_CHARS", 1000))
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "trace_id"}
+
+_listener = None
+
+
+def parse_sample_rates(spec: str) -> dict:
+    """Parse "event=rate,event=rate" into a dict"""
+    rates = {}
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        event, rate = item.split("=", 1)
+        try:
+            rates[event.strip()] = max(0.0, min(1.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of the records of each sampled event type"""
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if not self.rates or record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(getattr(record, "event", None))
+        return rate is None or random.random() < rate
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves message formatting to the listener thread.
+
+    The stock QueueHandler formats the message in the calling thread. Here only
+    exception info is rendered eagerly (tracebacks can't be passed around), and
+    the trace id is captured because it lives in a context variable.
+    """
+
+    def prepare(self, record):
+        record.trace_id = current_trace_id()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "trace_id", None):
+            data["trace_id"] = record.trace_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                data[key] = value
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def setup_logging():
+    """Route all logging through a queue to a background writer thread. Safe to call more than once"""
+    global _listener
+    if _listener is not None:
+        return
+
+    if os.environ.get("LOG_FORMAT", "json").lower() == "text":
+        formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+    else:
+        formatter = JsonFormatter()
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(parse_sample_rates(os.environ.get("LOG_SAMPLE_RATES", ""))))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Flush the queue and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def log_payload(logger: logging.Logger, event: str, message: str, payload):
+    """Log a request payload, only if LOG_PAYLOADS is enabled, truncated to LOG_PAYLOAD_MAX_CHARS"""
+    if not LOG_PAYLOADS or not logger.isEnabledFor(logging.INFO):
+        return
+    try:
+        text = json.dumps(payload, ensure_ascii=False, default=str)
+    except Exception:
+        text = repr(payload)
+    if len(text) > LOG_PAYLOAD_MAX_CHARS:
+        text = f"{text[:LOG_PAYLOAD_MAX_CHARS]}... ({len(text)} chars)"
+    logger.info("%s: %s", message, text, extra={"event": event})
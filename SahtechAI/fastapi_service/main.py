@@ -3,6 +3,7 @@ from fastapi.security import APIKeyHeader
 from pydantic import BaseModel, Field, validator, root_validator
 from typing import List, Dict, Any, Optional
 import os
+import asyncio
 from groq import Groq
 import logging
 import re
@@ -10,19 +11,30 @@ from dotenv import load_dotenv
 from unidecode import unidecode
 import json
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.responses import Response, PlainTextResponse, JSONResponse
 from starlette.requests import Request
 from datetime import datetime
 import httpx
 import requests
 from bs4 import BeautifulSoup
+from recommendation_cache import CacheRegenerator, RecommendationCache, build_archetype_key, build_cache_key, cache_dependencies
+from profile_canonicalization import ProfileKeyStats
+from tracing import TRACE_HEADER, TraceMiddleware, tracer, span, mark_span, set_attribute, current_trace_id
+from profiling import PROFILE_MODES, ProfileMiddleware, profiler
+from logging_setup import setup_logging, log_payload
+from agent import run_agent
+from alternatives import ProductCatalog
+from reference_data import AdditiveReference
+from readiness import UpstreamProbe, WarmupState
+from traffic_capture import TRAFFIC_CAPTURE_FILE, TRAFFIC_CAPTURE_SALT, TrafficCaptureMiddleware, TrafficRecorder
+from bulk import MsgpackMiddleware, NDJSONStreamingResponse, PrefixDispatchMiddleware, iter_records, stream_results
 # we gonna detailled the prompt more
 # Load environment variables from .env file
 load_dotenv()
 print(f"Loading environment variables from .env file")
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging - records go through a queue to a background writer thread (see logging_setup.py)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Initialize FastAPI app
@@ -32,6 +44,12 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# Streaming bulk endpoints live in their own app so they bypass the HTTP middlewares below (see bulk.py)
+bulk_app = FastAPI(
+    title="AI Recommendation Service - bulk",
+    description="Streaming NDJSON / msgpack bulk endpoints"
+)
+
 # Add CORS middleware to allow cross-origin requests from the frontend
 app.add_middleware(
     CORSMiddleware,
@@ -41,6 +59,16 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Opt-in capture of anonymized /predict and /normalize traffic for replay.py (see traffic_capture.py)
+if TRAFFIC_CAPTURE_FILE and not TRAFFIC_CAPTURE_SALT:
+    logger.error("TRAFFIC_CAPTURE_FILE is set but TRAFFIC_CAPTURE_SALT is not, traffic capture is disabled")
+traffic_recorder = TrafficRecorder(TRAFFIC_CAPTURE_FILE) if TRAFFIC_CAPTURE_FILE and TRAFFIC_CAPTURE_SALT else None
+if traffic_recorder:
+    app.add_middleware(TrafficCaptureMiddleware, recorder=traffic_recorder)
+
+# Lets the JSON endpoints accept and return msgpack (Content-Type / Accept: application/msgpack)
+app.add_middleware(MsgpackMiddleware)
+
 # Middleware to normalize all response data
 @app.middleware("http")
 async def normalize_response_middleware(request: Request, call_next):
@@ -52,7 +80,7 @@ async def normalize_response_middleware(request: Request, call_next):
         try:
             # Check if it's a streaming response (which doesn't have a body attribute)
             if "_StreamingResponse" in str(type(response)):
-                logger.info("Skipping normalization for streaming response")
+                logger.debug("Skipping normalization for streaming response")
                 return response
                 
             # Get response body
@@ -73,13 +101,25 @@ async def normalize_response_middleware(request: Request, call_next):
                 media_type="application/json"
             )
         except Exception as e:
-            logger.error(f"Error normalizing response: {str(e)}")
+            logger.error("Error normalizing response: %s", e)
             # Return original response if normalization fails
             return response
     
     # Return original response for non-JSON responses
     return response
 
+# Paths that get a trace (see tracing.py)
+TRACED_PATHS = {"/predict", "/predict/agent"}
+
+# Tracing middleware - registered after the normalization middleware so it wraps it and times the whole request
+app.add_middleware(TraceMiddleware, paths=TRACED_PATHS)
+
+# Profiling middleware - does nothing but check profiler.active unless a session was started from /debug/profile/start
+app.add_middleware(ProfileMiddleware)
+
+# Registered last so it is the outermost middleware
+app.add_middleware(PrefixDispatchMiddleware, prefix="/bulk", target=bulk_app)
+
 def normalize_dict_values(data):
     """Recursively normalize all string values in dictionaries and lists"""
     if isinstance(data, dict):
@@ -91,6 +131,9 @@ def normalize_dict_values(data):
     else:
         return data
 
+# Upstream error bodies are truncated before logging
+LOG_ERROR_BODY_MAX_CHARS = 500
+
 # API Key security
 API_KEY = os.environ.get("API_KEY", "sahtech-fastapi-secure-key-2025")  # Secure API key for Spring Boot integration
 api_key_header = APIKeyHeader(name="X-API-Key")
@@ -105,7 +148,7 @@ def verify_api_key(api_key: str = Security(api_key_header)):
 
 # Initialize Groq client - Get from environment or use a mock response if not available
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY", "")
-logger.info(f"GROQ_API_KEY present: {bool(GROQ_API_KEY)}")
+logger.info("GROQ_API_KEY present: %s", bool(GROQ_API_KEY), extra={"event": "startup.groq_key"})
 if not GROQ_API_KEY:
     logger.warning("⚠️ GROQ_API_KEY environment variable not set! The service will use mock responses.")
     client = None
@@ -114,7 +157,7 @@ else:
         client = Groq(api_key=GROQ_API_KEY)
         logger.info("✅ Groq client initialized successfully")
     except Exception as e:
-        logger.error(f"❌ Failed to initialize Groq client: {str(e)}")
+        logger.error("❌ Failed to initialize Groq client: %s", e, extra={"event": "startup.groq_client"})
         client = None
 
 # Spring Boot API endpoint
@@ -123,6 +166,31 @@ SPRING_BOOT_API = os.environ.get("SPRING_BOOT_API", "http://192.168.1.69:8080/AP
 # Initialize the httpx AsyncClient for making HTTP requests
 async_client = httpx.AsyncClient(timeout=10.0)
 
+# Web sources for additives information, scraped with a shared session so connections are reused
+ADDITIVE_SOURCE_1 = "https://www.additifs-alimentaires.net/additifs.php"
+ADDITIVE_SOURCE_2 = "https://www.quechoisir.org/comparatif-additifs-alimentaires-n56877/"
+ADDITIVES_MAX_AGE_SECONDS = float(os.environ.get("ADDITIVES_MAX_AGE_SECONDS", 24 * 3600))
+scrape_session = requests.Session()
+
+# Readiness: the worker only reports ready once the startup warm-up has run (see warm_up below)
+HEALTH_PROBE_INTERVAL_SECONDS = float(os.environ.get("HEALTH_PROBE_INTERVAL_SECONDS", 30))
+# Off by default: a Groq outage hits every worker at once, and pulling the whole fleet out of
+# rotation is worse than serving mock recommendations. When on, only sustained failures count.
+READY_REQUIRES_GROQ = os.environ.get("READY_REQUIRES_GROQ", "false").lower() in ("1", "true", "yes")
+READY_GROQ_MAX_FAILURES = int(os.environ.get("READY_GROQ_MAX_FAILURES", 3))
+groq_probe = UpstreamProbe("groq")
+warmup_state = WarmupState()
+
+# Recommendation cache - pre-generated entries for popular products are loaded from the warm cache file at startup
+WARM_CACHE_PATH = os.environ.get("WARM_CACHE_PATH", "warm_cache.json")
+recommendation_cache = RecommendationCache(max_entries=int(os.environ.get("RECOMMENDATION_CACHE_SIZE", 10000)))
+# Local product catalog used to rank healthier alternatives without calling the LLM
+PRODUCT_CATALOG_PATH = os.environ.get("PRODUCT_CATALOG_PATH", "product_catalog.jsonl")
+product_catalog = ProductCatalog()
+
+# Tracks how many distinct cache keys real profiles collapse into at each strictness level
+profile_key_stats = ProfileKeyStats()
+
 # Data models
 class HealthCondition(BaseModel):
     name: str
@@ -218,7 +286,7 @@ class ProductData(BaseModel):
         barcode_digits = re.sub(r'[^\d]', '', barcode_str)
         
         # Log validation for debugging purposes
-        logger.debug(f"Normalized barcode from '{v}' to '{barcode_digits}'")
+        logger.debug("Normalized barcode from '%s' to '%s'", v, barcode_digits)
         
         return barcode_digits
 
@@ -231,15 +299,35 @@ class RecommendationRequest(BaseModel):
         # This makes validation more tolerant
         extra = "ignore"
 
+class ProfileStartRequest(BaseModel):
+    mode: str = Field("sampling", description="'sampling' or 'deterministic'")
+    requests: int = Field(100, ge=1, le=10000, description="Profile at most this many requests")
+    seconds: float = Field(60.0, gt=0, le=600, description="Stop profiling after this many seconds")
+    interval_ms: float = Field(5.0, ge=1, le=1000, description="Sampling interval (sampling mode only)")
+
+    @validator('mode')
+    def validate_mode(cls, v):
+        if v not in PROFILE_MODES:
+            raise ValueError(f"mode must be one of {', '.join(PROFILE_MODES)}")
+        return v
+
+class AlternativesRequest(BaseModel):
+    user_data: UserData
+    product_data: ProductData
+    top_k: int = Field(5, ge=1, le=50)
+
+    class Config:
+        extra = "ignore"
+
 class RecommendationResponse(BaseModel):
     recommendation: str
     recommendation_type: str = Field(..., description="Type of recommendation: 'recommended', 'caution', or 'avoid'")
 
 # Helper function to send recommendation directly to Flutter
-async def send_to_flutter(callback_url: str, recommendation_data: dict):
+async def send_to_flutter(callback_url: str, recommendation_data: dict, trace_id: str = None):
     """Send recommendation data directly to Flutter app via the callback URL"""
     try:
-        logger.info(f"Sending recommendation directly to Flutter at: {callback_url}")
+        logger.info("Sending recommendation directly to Flutter at: %s", callback_url, extra={"event": "flutter.send"})
         
         # Make sure we have the right content
         if "recommendation" not in recommendation_data or "recommendation_type" not in recommendation_data:
@@ -247,22 +335,24 @@ async def send_to_flutter(callback_url: str, recommendation_data: dict):
             return False
             
         # Send an asynchronous POST request to the Flutter callback URL
+        headers = {"Content-Type": "application/json"}
+        if trace_id:
+            headers[TRACE_HEADER] = trace_id
         response = await async_client.post(
             callback_url,
             json=recommendation_data,
-            headers={"Content-Type": "application/json"}
+            headers=headers
         )
         
         if response.status_code == 200:
-            logger.info("Successfully sent recommendation directly to Flutter app")
+            logger.info("Successfully sent recommendation directly to Flutter app", extra={"event": "flutter.sent"})
             return True
         else:
-            logger.error(f"Error sending to Flutter: HTTP {response.status_code}")
-            logger.error(f"Response: {response.text}")
+            logger.error("Error sending to Flutter: HTTP %s - %s", response.status_code, response.text[:LOG_ERROR_BODY_MAX_CHARS])
             return False
             
     except Exception as e:
-        logger.error(f"Exception sending recommendation to Flutter: {str(e)}")
+        logger.error("Exception sending recommendation to Flutter: %s", e)
         return False
 
 # Helper functions
@@ -276,11 +366,12 @@ def format_system_prompt(user_data: UserData, product_data: ProductData) -> str:
     
     # Get additives information from web sources
     try:
-        additives_info_1 = get_additive_data("https://www.additifs-alimentaires.net/additifs.php")
-        additives_info_2 = get_additive_data("https://www.quechoisir.org/comparatif-additifs-alimentaires-n56877/")
-        logger.info(f"Retrieved {len(additives_info_1)} additives from source 1 and {len(additives_info_2)} from source 2")
+        with span("additive_lookup"):
+            additives_info_1 = additive_reference.get(ADDITIVE_SOURCE_1)
+            additives_info_2 = additive_reference.get(ADDITIVE_SOURCE_2)
+        logger.debug("Using %d additives from source 1 and %d from source 2", len(additives_info_1), len(additives_info_2))
     except Exception as e:
-        logger.error(f"Error retrieving additives information: {str(e)}")
+        logger.error("Error retrieving additives information: %s", e)
         additives_info_1 = []
         additives_info_2 = []
     
@@ -369,9 +460,29 @@ def normalize_text(text: str) -> str:
             
         return text
     except Exception as e:
-        logger.error(f"Error normalizing text: {str(e)}")
+        logger.error("Error normalizing text: %s", e)
         return text  # Return original text if normalization fails
 
+def normalize_product_data(product_data: ProductData) -> ProductData:
+    """Normalize the displayable product fields in place"""
+    if product_data.name:
+        product_data.name = normalize_text(product_data.name)
+    if product_data.brand:
+        product_data.brand = normalize_text(product_data.brand)
+    if product_data.category:
+        product_data.category = normalize_text(product_data.category)
+    if product_data.description:
+        product_data.description = normalize_text(product_data.description)
+    if product_data.type:
+        product_data.type = normalize_text(product_data.type)
+    
+    # Normalize ingredients and additives
+    if product_data.ingredients:
+        product_data.ingredients = [normalize_text(ing) for ing in product_data.ingredients]
+    if product_data.additives:
+        product_data.additives = [normalize_text(add) for add in product_data.additives]
+    return product_data
+
 def mock_recommendation(user_data: UserData, product_data: ProductData) -> str:
     """Generate a mock recommendation when Groq API is unavailable"""
     has_allergies = len(user_data.allergies) > 0
@@ -387,28 +498,27 @@ def mock_recommendation(user_data: UserData, product_data: ProductData) -> str:
     else:
         return "✓ Recommended - Ce produit semble etre compatible avec votre profil de sante. Consommez dans le cadre d'une alimentation equilibree et variee."
 
-def generate_ai_recommendation(user_data: UserData, product_data: ProductData) -> str:
-    """Generate AI recommendation using Groq or fallback to mock"""
-    try:
-        # Check if Groq client is available
-        if not client:
-            logger.warning("Using mock recommendation because Groq client is not available")
-            return mock_recommendation(user_data, product_data)
-        
-        # Get system prompt with enhanced additives information
+def request_groq_recommendation(user_data: UserData, product_data: ProductData) -> str:
+    """Call Groq for a recommendation. Raises if the client is unavailable or the API call fails"""
+    if not client:
+        raise RuntimeError("Groq client is not available")
+
+    # Get system prompt with enhanced additives information
+    with span("prompt_build"):
         system_prompt = format_system_prompt(user_data, product_data)
-        
-        # Create a user message that includes specific instructions for the ReAct framework
-        user_message = """
-        Please analyze this product for this user and provide a recommendation.
-        
-        Follow the ReAct framework:
-        1. First, think about the product ingredients and additives in relation to the user's health profile
-        2. Consider any potential risks or benefits
-        3. Make observations about specific ingredients or additives that may be concerning
-        4. Provide your final recommendation with clear reasoning
-        """
-        
+
+    # Create a user message that includes specific instructions for the ReAct framework
+    user_message = """
+    Please analyze this product for this user and provide a recommendation.
+    
+    Follow the ReAct framework:
+    1. First, think about the product ingredients and additives in relation to the user's health profile
+    2. Consider any potential risks or benefits
+    3. Make observations about specific ingredients or additives that may be concerning
+    4. Provide your final recommendation with clear reasoning
+    """
+
+    with span("llm_call"):
         completion = client.chat.completions.create(
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -418,17 +528,54 @@ def generate_ai_recommendation(user_data: UserData, product_data: ProductData) -
             temperature=0.3,
             max_tokens=500,
         )
+
+    recommendation = completion.choices[0].message.content
+    # Apply normalization to handle special characters
+    return normalize_text(recommendation)
+
+def generate_ai_recommendation(user_data: UserData, product_data: ProductData) -> str:
+    """Generate AI recommendation using the cache, Groq, or fallback to mock"""
+    profile_key_stats.record(user_data)
+    cache_key = build_cache_key(user_data, product_data)
+    with span("cache_lookup"):
+        cached = recommendation_cache.get(cache_key, build_archetype_key(user_data, product_data))
+    set_attribute("cache_hit", cached is not None)
+    if cached is not None:
+        recommendation_cache.link_user(cache_key, user_data.user_id)
+        logger.info("Serving recommendation from cache", extra={"event": "predict.cache_hit"})
+        return cached
+
+    try:
+        # Check if Groq client is available
+        if not client:
+            logger.warning("Using mock recommendation because Groq client is not available")
+            return mock_recommendation(user_data, product_data)
         
-        recommendation = completion.choices[0].message.content
-        # Apply normalization to handle special characters
-        return normalize_text(recommendation)
+        recommendation = request_groq_recommendation(user_data, product_data)
+        # Only real Groq answers are cached, mock fallbacks are not
+        recommendation_cache.put(cache_key, recommendation, dependencies=cache_dependencies(user_data, product_data), source=(user_data, product_data))
+        return recommendation
     
     except Exception as e:
-        logger.error(f"Error generating AI recommendation: {str(e)}")
+        logger.error("Error generating AI recommendation: %s", e)
         # Use mock response when API fails
         logger.info("Falling back to mock recommendation")
         return mock_recommendation(user_data, product_data)
 
+def regenerate_recommendation(user_data: UserData, product_data: ProductData):
+    """Re-generate and cache one invalidated recommendation (runs on the regenerator thread)"""
+    recommendation = request_groq_recommendation(user_data, product_data)
+    recommendation_cache.put(build_cache_key(user_data, product_data), recommendation, dependencies=cache_dependencies(user_data, product_data), source=(user_data, product_data))
+
+cache_regenerator = CacheRegenerator(regenerate_recommendation, rate=float(os.environ.get("CACHE_REGEN_RATE", 0.5)))
+
+def invalidation_response(result: dict, regenerate: bool, sources: list) -> dict:
+    """Evicted entries are re-generated from `sources` if asked and Groq is available"""
+    queued = cache_regenerator.submit(sources) if regenerate and client else 0
+    response = {key: value for key, value in result.items() if key != "sources"}
+    response["regeneration_queued"] = queued
+    return response
+
 # Web scraping function for additives information
 def get_additive_data(url):
     """
@@ -441,20 +588,119 @@ def get_additive_data(url):
         list: List of additives found on the page
     """
     try:
-        logger.info(f"Scraping additives data from {url}")
-        response = requests.get(url)
+        logger.info("Scraping additives data from %s", url, extra={"event": "additives.scrape"})
+        response = scrape_session.get(url, timeout=10)
         soup = BeautifulSoup(response.text, 'html.parser')
         
         additives = []
         for item in soup.find_all('li'):  # Change this based on the HTML structure
             additives.append(item.text)
         
-        logger.info(f"Successfully scraped {len(additives)} additives from {url}")
+        logger.info("Successfully scraped %d additives from %s", len(additives), url, extra={"event": "additives.scraped"})
         return additives
     except Exception as e:
-        logger.error(f"Error scraping additives from {url}: {str(e)}")
+        logger.error("Error scraping additives from %s: %s", url, e)
         return []
 
+# Additive reference data, loaded during warm-up and refreshed in the background
+CACHE_REGEN_ON_ADDITIVE_CHANGE = os.environ.get("CACHE_REGEN_ON_ADDITIVE_CHANGE", "false").lower() in ("1", "true", "yes")
+
+def on_additive_data_change(changed_entries: list):
+    """Additive data changed on refresh: evict the recommendations for products with those E-numbers"""
+    result = recommendation_cache.invalidate_additives(changed_entries)
+    logger.info("Additive data changed, invalidated %d cached recommendations in %sms", result["invalidated"], result["duration_ms"])
+    if CACHE_REGEN_ON_ADDITIVE_CHANGE and client:
+        cache_regenerator.submit(result["sources"])
+
+additive_reference = AdditiveReference(get_additive_data, [ADDITIVE_SOURCE_1, ADDITIVE_SOURCE_2], ADDITIVES_MAX_AGE_SECONDS, on_change=on_additive_data_change)
+
+# Startup
+WARMUP_SAMPLE_REQUEST = {
+    "user_data": {
+        "user_id": "warmup",
+        "age": 35,
+        "allergies": ["lactose"],
+        "health_conditions": ["diabetes"],
+        "objectives": ["weight_loss"]
+    },
+    "product_data": {
+        "name": "Warm-up product",
+        "barcode": "0000000000000",
+        "category": "gateau",
+        "ingredients": ["sucre", "farine de blé"],
+        "additives": ["E150d"],
+        "nutri_score": "E",
+        "nutrition_values": {"sugar": 15}
+    }
+}
+
+def probe_groq():
+    """Cheap authenticated call: checks the API key and upstream, and opens the TLS connection"""
+    client.models.list()
+
+def exercise_request_path():
+    """Run the validation, normalization, cache key and prompt code once so the first real request doesn't pay for it"""
+    request = RecommendationRequest(**WARMUP_SAMPLE_REQUEST)
+    normalize_product_data(request.product_data)
+    build_cache_key(request.user_data, request.product_data)
+    format_system_prompt(request.user_data, request.product_data)
+    determine_recommendation_type(mock_recommendation(request.user_data, request.product_data))
+    normalize_dict_values(WARMUP_SAMPLE_REQUEST)
+
+async def warm_up():
+    """Pre-warm connections, load reference data and exercise the request path, then mark the worker ready"""
+    warmup_state.begin()
+    steps = [
+        ("warm_cache", lambda: recommendation_cache.load_warm_file(WARM_CACHE_PATH)),
+        ("product_catalog", lambda: product_catalog.load(PRODUCT_CATALOG_PATH)),
+        ("additive_reference", additive_reference.refresh),
+        ("request_path", exercise_request_path),
+        ("openapi_schema", app.openapi),
+    ]
+    if client:
+        steps.insert(0, ("groq_probe", lambda: groq_probe.run(probe_groq)))
+    for name, func in steps:
+        await asyncio.to_thread(warmup_state.step, name, func)
+    warmup_state.finish()
+    logger.info("Warm-up finished in %sms", warmup_state.duration_ms)
+
+async def refresh_in_background():
+    """Re-probe upstreams and refresh stale reference data, so health endpoints only read cached results"""
+    while True:
+        await asyncio.sleep(HEALTH_PROBE_INTERVAL_SECONDS)
+        try:
+            if client:
+                await asyncio.to_thread(groq_probe.run, probe_groq)
+            if additive_reference.is_stale():
+                await asyncio.to_thread(additive_reference.refresh)
+        except Exception as e:
+            logger.error("Background refresh failed: %s", e)
+
+background_jobs = []
+
+@app.on_event("startup")
+async def start_warm_up():
+    # Run in the background so the liveness probe answers while the worker warms up
+    background_jobs.append(asyncio.create_task(warm_up()))
+    background_jobs.append(asyncio.create_task(refresh_in_background()))
+
+@app.on_event("shutdown")
+async def stop_background_jobs():
+    for job in background_jobs:
+        job.cancel()
+
+def readiness_report() -> dict:
+    groq_ok = groq_probe.consecutive_failures < READY_GROQ_MAX_FAILURES
+    groq_required = READY_REQUIRES_GROQ and bool(GROQ_API_KEY)
+    return {
+        "ready": warmup_state.warm and (groq_ok or not groq_required),
+        "warmup": warmup_state.status(),
+        "groq_api": {"configured": bool(GROQ_API_KEY), "required": groq_required, **groq_probe.status()},
+        "additive_reference": additive_reference.status(),
+        "warm_cache_entries": recommendation_cache.stats()["pinned_entries"],
+        "product_catalog": {"products": product_catalog.product_count, "categories": len(product_catalog.categories)},
+    }
+
 # Endpoints
 @app.get("/")
 async def root():
@@ -462,19 +708,143 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    # Check if Groq client is available
-    groq_status = "available" if client else "unavailable"
+    # Groq is only reported available if the last probe with the API key succeeded
+    groq_status = "available" if client and groq_probe.ok else "unavailable"
     return {
         "status": "healthy",
         "groq_api": groq_status
     }
 
+@app.get("/health/live")
+async def liveness():
+    """The process is up and serving requests"""
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def readiness():
+    """Ready only once warmed up and, if configured, Groq answered the last probe. Reads cached results only"""
+    report = readiness_report()
+    return JSONResponse(
+        status_code=status.HTTP_200_OK if report["ready"] else status.HTTP_503_SERVICE_UNAVAILABLE,
+        content=report
+    )
+
+@app.get("/cache/stats", dependencies=[Depends(verify_api_key)])
+async def cache_stats():
+    """Hit/miss counters and size of the recommendation cache, and how much profile canonicalization collapses keys"""
+    return {
+        **recommendation_cache.stats(),
+        "regeneration": cache_regenerator.stats(),
+        "profile_keys": profile_key_stats.report()
+    }
+
+@app.post("/cache/invalidate/user/{user_id}", dependencies=[Depends(verify_api_key)])
+async def invalidate_user_cache(user_id: str, user_data: Optional[UserData] = None, regenerate: bool = False):
+    """
+    Evict the cached recommendations of a user whose profile changed.
+
+    With regenerate=true and the updated profile as body, the evicted products are
+    re-generated for the new profile in the background.
+    """
+    if regenerate and user_data is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="regenerate=true needs the updated user_data as body")
+    try:
+        result = recommendation_cache.invalidate_user(user_id)
+        sources = [(user_data, product) for _, product in result["sources"]] if user_data else []
+        return invalidation_response(result, regenerate, sources)
+    except Exception as e:
+        logger.error("Error invalidating cache for user %s: %s", user_id, e)
+        raise HTTPException(status_code=500, detail=f"Failed to invalidate cache: {str(e)}")
+
+@app.post("/cache/invalidate/product/{barcode}", dependencies=[Depends(verify_api_key)])
+async def invalidate_product_cache(barcode: str, product_data: Optional[ProductData] = None, regenerate: bool = False):
+    """
+    Evict the cached recommendations of a product, e.g. after its ingredients were corrected.
+
+    With regenerate=true and the corrected product data as body, they are re-generated
+    from it in the background. Regenerating from the old data would only re-cache the
+    stale answer, so the body is required.
+    """
+    if regenerate and product_data is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="regenerate=true needs the corrected product_data as body")
+    try:
+        result = recommendation_cache.invalidate_product(barcode)
+        if product_data:
+            product_data = normalize_product_data(product_data)
+            sources = [(user, product_data) for user, _ in result["sources"]]
+        else:
+            sources = []
+        return invalidation_response(result, regenerate, sources)
+    except Exception as e:
+        logger.error("Error invalidating cache for product %s: %s", barcode, e)
+        raise HTTPException(status_code=500, detail=f"Failed to invalidate cache: {str(e)}")
+
+@app.post("/cache/invalidate/additive/{code}", dependencies=[Depends(verify_api_key)])
+async def invalidate_additive_cache(code: str, regenerate: bool = False):
+    """Evict the cached recommendations of every product containing this additive (E-number), e.g. after its risk data changed"""
+    try:
+        result = recommendation_cache.invalidate_additives([code])
+        return invalidation_response(result, regenerate, result["sources"])
+    except Exception as e:
+        logger.error("Error invalidating cache for additive %s: %s", code, e)
+        raise HTTPException(status_code=500, detail=f"Failed to invalidate cache: {str(e)}")
+
+@app.get("/debug/traces", dependencies=[Depends(verify_api_key)])
+async def debug_traces(slow_only: bool = False, limit: int = 50):
+    """Most recent recorded traces (sampled or slow), newest first"""
+    return tracer.snapshot(slow_only=slow_only, limit=limit)
+
+@app.get("/debug/traces/{trace_id}", dependencies=[Depends(verify_api_key)])
+async def debug_trace(trace_id: str):
+    """A single recorded trace by id"""
+    trace = tracer.get(trace_id)
+    if trace is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Trace {trace_id} not found (not sampled or already rotated out)"
+        )
+    return trace
+
+@app.post("/debug/profile/start", dependencies=[Depends(verify_api_key)])
+async def start_profiling(config: ProfileStartRequest):
+    """Profile the next N requests or T seconds, whichever comes first"""
+    try:
+        profiler.start(config.mode, config.requests, config.seconds, config.interval_ms)
+    except RuntimeError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    logger.info("Profiling started: mode=%s, requests=%s, seconds=%s", config.mode, config.requests, config.seconds, extra={"event": "profile.started"})
+    return {"status": "started", **config.dict()}
+
+@app.post("/debug/profile/stop", dependencies=[Depends(verify_api_key)])
+async def stop_profiling():
+    """Stop the running profiling session and return its results"""
+    session = profiler.stop("stopped")
+    if session is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No profiling session is running")
+    return session.summary()
+
+@app.get("/debug/profile", dependencies=[Depends(verify_api_key)])
+async def get_profile(limit: int = 30):
+    """Top functions by cumulative time for the running or last profiling session"""
+    session = profiler.current()
+    if session is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No profiling session has been run")
+    return {"active": session is profiler.active, **session.summary(limit)}
+
+@app.get("/debug/profile/collapsed", dependencies=[Depends(verify_api_key)], response_class=PlainTextResponse)
+async def get_profile_collapsed():
+    """Collapsed stacks of the running or last sampling session, for flamegraph.pl or speedscope"""
+    session = profiler.current()
+    if session is None or session.mode != "sampling":
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No sampling profile available")
+    return session.collapsed_stacks()
+
 @app.post("/debug", dependencies=[Depends(verify_api_key)])
 async def debug_request(request_data: dict):
     """Debug endpoint to validate incoming request data structure"""
     try:
-        # Log the raw request data for debugging
-        logger.info(f"Received debug request: {request_data}")
+        # Log the raw request data for debugging (only when LOG_PAYLOADS is enabled)
+        log_payload(logger, "debug.payload", "Received debug request", request_data)
         
         # Try to parse user_data
         user_data = None
@@ -483,7 +853,7 @@ async def debug_request(request_data: dict):
                 user_data = UserData(**request_data["user_data"])
                 logger.info("✅ User data validated successfully")
             except Exception as e:
-                logger.error(f"❌ User data validation error: {str(e)}")
+                logger.error("❌ User data validation error: %s", e)
                 return {"error": f"User data validation failed: {str(e)}"}
         else:
             return {"error": "Missing 'user_data' field in request"}
@@ -495,7 +865,7 @@ async def debug_request(request_data: dict):
                 product_data = ProductData(**request_data["product_data"])
                 logger.info("✅ Product data validated successfully")
             except Exception as e:
-                logger.error(f"❌ Product data validation error: {str(e)}")
+                logger.error("❌ Product data validation error: %s", e)
                 return {"error": f"Product data validation failed: {str(e)}"}
         else:
             return {"error": "Missing 'product_data' field in request"}
@@ -509,143 +879,216 @@ async def debug_request(request_data: dict):
         }
         
     except Exception as e:
-        logger.error(f"❌ Debug request error: {str(e)}")
+        logger.error("❌ Debug request error: %s", e)
         return {"error": f"Debug request failed: {str(e)}"}
 
 @app.post("/normalize", dependencies=[Depends(verify_api_key)])
 async def normalize_data(data: dict):
     """Normalize any text data sent to this endpoint"""
     try:
-        logger.info(f"Received normalization request")
+        logger.info("Received normalization request", extra={"event": "normalize.received"})
         
         # Normalize all string values recursively
         normalized_data = normalize_dict_values(data)
         
-        logger.info(f"Successfully normalized data")
+        logger.info("Successfully normalized data", extra={"event": "normalize.done"})
         
         return normalized_data
     
     except Exception as e:
-        logger.error(f"Error normalizing data: {str(e)}")
+        logger.error("Error normalizing data: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to normalize data: {str(e)}"
         )
 
+def finalize_recommendation(request: RecommendationRequest, recommendation: str, background_tasks: Optional[BackgroundTasks] = None) -> dict:
+    """Build the response for Spring Boot and queue the Flutter callback if one was provided (and background_tasks is given)"""
+    # Determine recommendation type
+    recommendation_type = determine_recommendation_type(recommendation)
+    
+    logger.info("Generated recommendation of type '%s' for user %s", recommendation_type, request.user_data.user_id, extra={"event": "predict.generated"})
+    
+    # Normalize the recommendation text
+    normalized_recommendation = normalize_text(recommendation)
+    
+    # Create the response object with recommendation data
+    response_data = {
+        "recommendation": normalized_recommendation,
+        "recommendation_type": recommendation_type,
+        # Include normalized product data in response for the frontend to use
+        "product_data": {
+            "name": request.product_data.name,
+            "brand": request.product_data.brand,
+            "category": request.product_data.category,
+            "description": request.product_data.description,
+            "type": request.product_data.type,
+            "ingredients": request.product_data.ingredients,
+            "additives": request.product_data.additives,
+            "nutri_score": request.product_data.nutri_score,
+            "nutri_score_description": normalize_text(request.product_data.nutri_score_description) if request.product_data.nutri_score_description else None
+        }
+    }
+    
+    # If Flutter callback URL was provided, send recommendation directly to Flutter
+    if request.flutter_callback_url and background_tasks is not None:
+        # Create a simplified version of the response for Flutter
+        flutter_data = {
+            "recommendation": normalized_recommendation,
+            "recommendation_type": recommendation_type,
+            "product_id": request.product_data.id,
+            "timestamp": datetime.now().isoformat()
+        }
+        
+        # Send recommendation to Flutter asynchronously (don't wait for response)
+        with span("callback_enqueue"):
+            background_tasks.add_task(
+                send_to_flutter, 
+                request.flutter_callback_url, 
+                flutter_data,
+                current_trace_id()
+            )
+        logger.info("Recommendation will be sent to Flutter in background", extra={"event": "predict.callback_enqueued"})
+    
+    return response_data
+
 @app.post("/predict", dependencies=[Depends(verify_api_key)])
 async def predict(request: RecommendationRequest, background_tasks: BackgroundTasks):
     """Generate a personalized recommendation based on user and product data"""
+    # Body parsing and pydantic validation happen before the handler runs
+    mark_span("validation")
     try:
-        logger.info(f"Received recommendation request for user {request.user_data.user_id} and product {request.product_data.name}")
+        logger.info("Received recommendation request for user %s and product %s", request.user_data.user_id, request.product_data.name, extra={"event": "predict.received"})
         
         # Check if a Flutter callback URL was provided
         has_flutter_callback = request.flutter_callback_url is not None and request.flutter_callback_url != ""
         if has_flutter_callback:
-            logger.info(f"Flutter callback URL provided: {request.flutter_callback_url}")
+            logger.info("Flutter callback URL provided: %s", request.flutter_callback_url, extra={"event": "predict.callback_url"})
         
         # Log the barcode value for debugging
-        logger.info(f"Product barcode: {request.product_data.barcode} (type: {type(request.product_data.barcode).__name__})")
+        logger.debug("Product barcode: %s", request.product_data.barcode)
         
         # Normalize product data first to ensure proper display in the UI
-        if request.product_data.name:
-            request.product_data.name = normalize_text(request.product_data.name)
-        if request.product_data.brand:
-            request.product_data.brand = normalize_text(request.product_data.brand)
-        if request.product_data.category:
-            request.product_data.category = normalize_text(request.product_data.category)
-        if request.product_data.description:
-            request.product_data.description = normalize_text(request.product_data.description)
-        if request.product_data.type:
-            request.product_data.type = normalize_text(request.product_data.type)
-        
-        # Normalize ingredients and additives
-        if request.product_data.ingredients:
-            request.product_data.ingredients = [normalize_text(ing) for ing in request.product_data.ingredients]
-        if request.product_data.additives:
-            request.product_data.additives = [normalize_text(add) for add in request.product_data.additives]
+        with span("normalization"):
+            normalize_product_data(request.product_data)
         
         # Generate recommendation using AI or mock if not available
         recommendation = generate_ai_recommendation(request.user_data, request.product_data)
         
-        # Determine recommendation type
-        recommendation_type = determine_recommendation_type(recommendation)
+        response_data = finalize_recommendation(request, recommendation, background_tasks)
         
-        logger.info(f"Generated recommendation of type '{recommendation_type}' for user {request.user_data.user_id}")
-        
-        # Normalize the recommendation text
-        normalized_recommendation = normalize_text(recommendation)
+        # Return in format Spring Boot expects (this goes back to Spring Boot)
+        return response_data
+    
+    except Exception as e:
+        logger.error("Error processing recommendation request: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to process recommendation: {str(e)}"
+        )
+
+@app.post("/predict/agent", dependencies=[Depends(verify_api_key)])
+async def predict_agent(request: RecommendationRequest, background_tasks: BackgroundTasks):
+    """Generate a recommendation with the multi-step ReAct agent (see agent.py)"""
+    mark_span("validation")
+    try:
+        logger.info("Received agent recommendation request for user %s and product %s", request.user_data.user_id, request.product_data.name, extra={"event": "agent.received"})
         
-        # Create the response object with recommendation data
-        response_data = {
-            "recommendation": normalized_recommendation,
-            "recommendation_type": recommendation_type,
-            # Include normalized product data in response for the frontend to use
-            "product_data": {
-                "name": request.product_data.name,
-                "brand": request.product_data.brand,
-                "category": request.product_data.category,
-                "description": request.product_data.description,
-                "type": request.product_data.type,
-                "ingredients": request.product_data.ingredients,
-                "additives": request.product_data.additives,
-                "nutri_score": request.product_data.nutri_score,
-                "nutri_score_description": normalize_text(request.product_data.nutri_score_description) if request.product_data.nutri_score_description else None
-            }
-        }
+        with span("normalization"):
+            normalize_product_data(request.product_data)
         
-        # If Flutter callback URL was provided, send recommendation directly to Flutter
-        if has_flutter_callback:
-            logger.info("Sending recommendation directly to Flutter app")
-            # Create a simplified version of the response for Flutter
-            flutter_data = {
-                "recommendation": normalized_recommendation,
-                "recommendation_type": recommendation_type,
-                "product_id": request.product_data.id,
-                "timestamp": datetime.now().isoformat()
-            }
-            
-            # Send recommendation to Flutter asynchronously (don't wait for response)
-            background_tasks.add_task(
-                send_to_flutter, 
-                request.flutter_callback_url, 
-                flutter_data
+        answer = None
+        agent_stats = None
+        if client:
+            answer, agent_stats = await run_agent(client, request.user_data.dict(), request.product_data.dict())
+            logger.info(
+                "Agent finished with '%s' after %d round trips in %sms",
+                agent_stats["stop_reason"], agent_stats["round_trips"], agent_stats["duration_ms"],
+                extra={"event": "agent.finished"}
             )
-            logger.info("Recommendation will be sent to Flutter in background")
+        else:
+            logger.warning("Using mock recommendation because Groq client is not available")
         
-        # Return in format Spring Boot expects (this goes back to Spring Boot)
+        # No answer within the iteration/time caps: fall back to the rule based recommendation
+        recommendation = normalize_text(answer) if answer else mock_recommendation(request.user_data, request.product_data)
+        
+        response_data = finalize_recommendation(request, recommendation, background_tasks)
+        response_data["agent"] = agent_stats
         return response_data
     
     except Exception as e:
-        logger.error(f"Error processing recommendation request: {str(e)}")
+        logger.error("Error processing agent recommendation request: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to process recommendation: {str(e)}"
         )
 
+@app.post("/alternatives", dependencies=[Depends(verify_api_key)])
+async def alternatives(request: AlternativesRequest):
+    """Top-k healthier products of the same category for this user, ranked from the local catalog"""
+    if not product_catalog.categories:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Product catalog is not loaded"
+        )
+    try:
+        normalize_product_data(request.product_data)
+        return product_catalog.rank(request.user_data, request.product_data, request.top_k)
+    except Exception as e:
+        logger.error("Error ranking alternatives: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to rank alternatives: {str(e)}"
+        )
+
+async def bulk_predict_record(record: dict) -> dict:
+    """One /bulk/predict record: same processing as /predict, without the Flutter callback"""
+    request = RecommendationRequest(**record)
+    normalize_product_data(request.product_data)
+    # Groq calls are blocking, run them off the event loop so records are processed concurrently
+    recommendation = await asyncio.to_thread(generate_ai_recommendation, request.user_data, request.product_data)
+    return finalize_recommendation(request, recommendation)
+
+async def bulk_normalize_record(record) -> dict:
+    """One /bulk/normalize record"""
+    return normalize_dict_values(record)
+
+@bulk_app.post("/bulk/predict", dependencies=[Depends(verify_api_key)])
+async def bulk_predict(request: Request):
+    """Stream of RecommendationRequest records (NDJSON or msgpack) in, NDJSON results out in input order"""
+    logger.info("Received bulk recommendation request", extra={"event": "bulk.received"})
+    return NDJSONStreamingResponse(stream_results(iter_records(request), bulk_predict_record))
+
+@bulk_app.post("/bulk/normalize", dependencies=[Depends(verify_api_key)])
+async def bulk_normalize(request: Request):
+    """Stream of records to normalize (NDJSON or msgpack) in, NDJSON results out in input order"""
+    logger.info("Received bulk normalization request", extra={"event": "bulk.received"})
+    return NDJSONStreamingResponse(stream_results(iter_records(request), bulk_normalize_record))
+
 @app.get("/test-additives", dependencies=[Depends(verify_api_key)])
 async def test_additives_scraping():
     """Test endpoint to verify the web scraping functionality for additives information"""
     try:
         # Scrape additives data from the two sources
-        additives_1 = get_additive_data("https://www.additifs-alimentaires.net/additifs.php")
-        additives_2 = get_additive_data("https://www.quechoisir.org/comparatif-additifs-alimentaires-n56877/")
+        additives_1 = get_additive_data(ADDITIVE_SOURCE_1)
+        additives_2 = get_additive_data(ADDITIVE_SOURCE_2)
         
         # Return the results
         return {
             "status": "success",
             "source_1": {
-                "url": "https://www.additifs-alimentaires.net/additifs.php",
+                "url": ADDITIVE_SOURCE_1,
                 "count": len(additives_1),
                 "sample": additives_1[:10] if len(additives_1) > 10 else additives_1
             },
             "source_2": {
-                "url": "https://www.quechoisir.org/comparatif-additifs-alimentaires-n56877/",
+                "url": ADDITIVE_SOURCE_2,
                 "count": len(additives_2),
                 "sample": additives_2[:10] if len(additives_2) > 10 else additives_2
             }
         }
     except Exception as e:
-        logger.error(f"Error testing additives scraping: {str(e)}")
+        logger.error("Error testing additives scraping: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to test additives scraping: {str(e)}"
@@ -656,5 +1099,5 @@ if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
     host = os.environ.get("HOST", "0.0.0.0")
     # Default port to 8000 if not specified, but Spring Boot is configured to use 8000
-    logger.info(f"Starting AI Recommendation Service on {host}:{port}")
+    logger.info("Starting AI Recommendation Service on %s:%s", host, port, extra={"event": "startup.listen"})
     uvicorn.run("main:app", host=host, port=port, reload=True)
@@ -0,0 +1,250 @@
+"""
+Offline pre-generation of recommendations for popular products.
+
+Generates a recommendation for every (product, profile archetype) pair and
+writes them to the warm cache file that the service loads at startup.
+
+Usage:
+    python pregenerate.py --products top_products.json --output warm_cache.json
+    python pregenerate.py --products top_products.jsonl --archetypes archetypes.json --workers 4 --rate 2
+
+The products file is a JSON list (or JSON lines) of product_data objects, in the
+same format Spring Boot sends to /predict. Progress is checkpointed to
+<output>.checkpoint.jsonl, so an interrupted run picks up where it stopped.
+
+Entries are stored under archetype keys (conditions, allergies and objectives
+only), which the service falls back to when a user's full key misses. After
+writing, the file is checked: a typical Spring Boot profile of each archetype
+(with age, gender, weight, height and BMI) must be served from it. Run only that
+check on an existing file with --check.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import main
+from main import ProductData, UserData, determine_recommendation_type, normalize_product_data, request_groq_recommendation
+from recommendation_cache import RecommendationCache, build_archetype_key, build_cache_key, cache_dependencies, save_warm_file
+
+logger = logging.getLogger("pregenerate")
+
+# The profile shapes most of our users fall into
+DEFAULT_ARCHETYPES = {
+    "none": {
+        "user_id": "archetype_none",
+    },
+    "diabetic": {
+        "user_id": "archetype_diabetic",
+        "health_conditions": ["diabetes"],
+        "has_chronic_disease": True,
+    },
+    "hypertensive": {
+        "user_id": "archetype_hypertensive",
+        "health_conditions": ["hypertension"],
+        "has_chronic_disease": True,
+    },
+    "lactose_intolerant": {
+        "user_id": "archetype_lactose_intolerant",
+        "allergies": ["lactose"],
+        "has_allergies": True,
+    },
+}
+
+# Fields Spring Boot sends for every user, added to each archetype for the coverage check
+TYPICAL_PROFILE_FIELDS = {
+    "age": 35,
+    "gender": "male",
+    "weight": 75.5,
+    "height": 175.0,
+    "bmi": 24.7,
+    "activity_level": "moderate",
+    "preferred_language": "french",
+}
+
+
+class RateLimiter:
+    """Spaces out calls across all worker threads to at most `rate` calls per second"""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def load_records(path: str) -> list:
+    """Load a JSON list or a JSON lines file"""
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read().strip()
+    if not text:
+        return []
+    if text.startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def load_archetypes(path: str) -> dict:
+    if not path:
+        return DEFAULT_ARCHETYPES
+    with open(path, "r", encoding="utf-8") as f:
+        archetypes = json.load(f)
+    for name, profile in archetypes.items():
+        profile.setdefault("user_id", f"archetype_{name}")
+    return archetypes
+
+
+def load_checkpoint(path: str) -> dict:
+    """Read completed entries from the checkpoint file, keyed by cache key"""
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A partially written last line after a crash, it will be regenerated
+                continue
+            done[record["key"]] = record
+    return done
+
+
+def generate_one(limiter: RateLimiter, key: str, barcode: str, archetype: str, user_data: UserData, product_data: ProductData, retries: int) -> dict:
+    for attempt in range(1, retries + 1):
+        limiter.wait()
+        try:
+            recommendation = request_groq_recommendation(user_data, product_data)
+            return {
+                "key": key,
+                "barcode": barcode,
+                "archetype": archetype,
+                "additives": cache_dependencies(user_data, product_data)["additives"],
+                "recommendation": recommendation,
+                "recommendation_type": determine_recommendation_type(recommendation),
+            }
+        except Exception as e:
+            logger.warning("Attempt %d/%d failed for %s / %s: %s", attempt, retries, barcode, archetype, e, extra={"event": "pregenerate.retry"})
+            time.sleep(min(2 ** attempt, 30))
+    raise RuntimeError(f"Giving up on {barcode} / {archetype} after {retries} attempts")
+
+
+def check_warm_cache(path: str, products: list, archetypes: dict) -> int:
+    """
+    Load the warm cache as the service does and look up a typical real profile of
+    each archetype for each product. Returns the number of lookups that missed.
+    """
+    cache = RecommendationCache()
+    if not cache.load_warm_file(path):
+        logger.error("Warm cache %s could not be loaded", path)
+        return len(products) * len(archetypes) or 1
+    missed = 0
+    for raw_product in products:
+        product_data = normalize_product_data(ProductData(**raw_product))
+        if not product_data.barcode:
+            continue
+        for name, profile in archetypes.items():
+            user_data = UserData(**{**TYPICAL_PROFILE_FIELDS, **profile, "user_id": "coverage_check"})
+            if cache.get(build_cache_key(user_data, product_data), build_archetype_key(user_data, product_data)) is None:
+                missed += 1
+                logger.warning("A typical %s profile misses the warm cache for %s", name, product_data.barcode)
+    stats = cache.stats()
+    logger.info("Coverage check: %d/%d typical profiles served from %s", stats["hits"], stats["hits"] + stats["misses"], path)
+    return missed
+
+
+def run(args) -> int:
+    if args.check:
+        return 1 if check_warm_cache(args.output, load_records(args.products), load_archetypes(args.archetypes)) else 0
+
+    if not main.client:
+        logger.error("GROQ_API_KEY is not set or the Groq client failed to initialize, nothing to generate")
+        return 1
+
+    products = load_records(args.products)
+    archetypes = load_archetypes(args.archetypes)
+    checkpoint_path = args.checkpoint or f"{args.output}.checkpoint.jsonl"
+    done = load_checkpoint(checkpoint_path)
+    logger.info("%d products x %d archetypes, %d already in checkpoint", len(products), len(archetypes), len(done), extra={"event": "pregenerate.plan"})
+
+    # Build the work list, skipping pairs that are already checkpointed
+    jobs = []
+    for raw_product in products:
+        product_data = normalize_product_data(ProductData(**raw_product))
+        if not product_data.barcode:
+            logger.warning("Skipping product without barcode: %s", product_data.name, extra={"event": "pregenerate.skipped"})
+            continue
+        for name, profile in archetypes.items():
+            user_data = UserData(**profile)
+            key = build_archetype_key(user_data, product_data)
+            if key not in done:
+                jobs.append((key, product_data.barcode, name, user_data, product_data))
+
+    limiter = RateLimiter(args.rate)
+    failures = 0
+    with open(checkpoint_path, "a", encoding="utf-8") as checkpoint, ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(generate_one, limiter, key, barcode, name, user_data, product_data, args.retries): key
+            for key, barcode, name, user_data, product_data in jobs
+        }
+        for i, future in enumerate(as_completed(futures), start=1):
+            try:
+                record = future.result()
+            except Exception as e:
+                failures += 1
+                logger.error(str(e))
+                continue
+            done[record["key"]] = record
+            checkpoint.write(json.dumps(record, ensure_ascii=False) + "\n")
+            checkpoint.flush()
+            if i % 50 == 0 or i == len(futures):
+                logger.info("Progress: %d/%d (%d failed)", i, len(futures), failures, extra={"event": "pregenerate.progress"})
+
+    entries = {
+        key: {
+            "recommendation": record["recommendation"],
+            "recommendation_type": record["recommendation_type"],
+            "barcode": record["barcode"],
+            "archetype": record["archetype"],
+            "additives": record.get("additives", []),
+        }
+        for key, record in done.items()
+    }
+    save_warm_file(args.output, entries)
+    logger.info("Wrote %d entries to %s (%d failed, rerun to retry them)", len(entries), args.output, failures, extra={"event": "pregenerate.written"})
+    missed = check_warm_cache(args.output, products, archetypes)
+    return 1 if failures or missed else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-generate recommendations for popular products into a warm cache file")
+    parser.add_argument("--products", required=True, help="JSON or JSON lines file of product_data objects")
+    parser.add_argument("--archetypes", help="JSON file mapping archetype name to user_data (default: built-in archetypes)")
+    parser.add_argument("--output", default=main.WARM_CACHE_PATH, help="Warm cache file to write")
+    parser.add_argument("--checkpoint", help="Checkpoint file (default: <output>.checkpoint.jsonl)")
+    parser.add_argument("--workers", type=int, default=4, help="Number of parallel workers")
+    parser.add_argument("--rate", type=float, default=2.0, help="Max Groq calls per second across all workers (0 = unlimited)")
+    parser.add_argument("--retries", type=int, default=3, help="Attempts per pair before giving up")
+    parser.add_argument("--check", action="store_true", help="Only check that typical profiles are served from an existing --output file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(run(parse_args()))
@@ -0,0 +1,292 @@
+"""
+Profile canonicalization for recommendation cache keys.
+
+Users with the same clinically relevant profile should share cache entries, even
+if their exact age or BMI differ or their conditions are typed in another order,
+case or language. canonical_profile() maps a UserData to a stable dict with only
+the fields the prompt uses.
+
+Strictness levels (PROFILE_KEY_STRICTNESS):
+- exact: raw prompt fields, no normalization (previous behaviour)
+- normalized: lists are cleaned, synonym-mapped, deduplicated and sorted
+- banded: normalized + age and BMI bucketed into bands (default)
+
+Run this file on a JSON lines dump of user_data objects to see how many distinct
+keys real traffic collapses into at each level:
+    python profile_canonicalization.py profiles.jsonl
+"""
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+
+from unidecode import unidecode
+
+STRICTNESS_LEVELS = ("exact", "normalized", "banded")
+DEFAULT_STRICTNESS = os.environ.get("PROFILE_KEY_STRICTNESS", "banded")
+if DEFAULT_STRICTNESS not in STRICTNESS_LEVELS:
+    DEFAULT_STRICTNESS = "banded"
+
+# Upper bound (exclusive) of each age band
+AGE_BANDS = [
+    (13, "child"),
+    (18, "teen"),
+    (40, "adult_18_39"),
+    (65, "adult_40_64"),
+    (200, "senior_65_plus"),
+]
+
+# WHO adult BMI categories
+BMI_BANDS = [
+    (18.5, "underweight"),
+    (25.0, "normal"),
+    (30.0, "overweight"),
+    (35.0, "obese_1"),
+    (40.0, "obese_2"),
+    (1000.0, "obese_3"),
+]
+
+# Synonyms are matched after lowercasing, accent removal and whitespace/underscore cleanup
+CONDITION_SYNONYMS = {
+    "diabete": "diabetes",
+    "diabetes": "diabetes",
+    "diabetique": "diabetes",
+    "diabetic": "diabetes",
+    "diabete type 1": "diabetes_type_1",
+    "type 1 diabetes": "diabetes_type_1",
+    "diabetes type 1": "diabetes_type_1",
+    "diabete type 2": "diabetes_type_2",
+    "type 2 diabetes": "diabetes_type_2",
+    "diabetes type 2": "diabetes_type_2",
+    "hypertension": "hypertension",
+    "hypertension arterielle": "hypertension",
+    "high blood pressure": "hypertension",
+    "tension arterielle": "hypertension",
+    "tension": "hypertension",
+    "cholesterol": "high_cholesterol",
+    "high cholesterol": "high_cholesterol",
+    "hypercholesterolemie": "high_cholesterol",
+    "celiac": "celiac_disease",
+    "celiac disease": "celiac_disease",
+    "coeliac disease": "celiac_disease",
+    "maladie coeliaque": "celiac_disease",
+    "obesity": "obesity",
+    "obesite": "obesity",
+    "anemia": "anemia",
+    "anemie": "anemia",
+    "iron deficiency anemia": "anemia",
+    "kidney disease": "kidney_disease",
+    "insuffisance renale": "kidney_disease",
+}
+
+ALLERGY_SYNONYMS = {
+    "lactose": "lactose",
+    "lactose intolerance": "lactose",
+    "intolerance au lactose": "lactose",
+    "lait": "milk",
+    "milk": "milk",
+    "milk allergy": "milk",
+    "dairy": "milk",
+    "peanut": "peanuts",
+    "peanuts": "peanuts",
+    "arachide": "peanuts",
+    "arachides": "peanuts",
+    "cacahuete": "peanuts",
+    "cacahuetes": "peanuts",
+    "gluten": "gluten",
+    "ble": "gluten",
+    "wheat": "gluten",
+    "nuts": "tree_nuts",
+    "tree nuts": "tree_nuts",
+    "fruits a coque": "tree_nuts",
+    "noix": "tree_nuts",
+    "egg": "eggs",
+    "eggs": "eggs",
+    "oeuf": "eggs",
+    "oeufs": "eggs",
+    "soy": "soy",
+    "soja": "soy",
+    "fish": "fish",
+    "poisson": "fish",
+    "shellfish": "shellfish",
+    "crustaces": "shellfish",
+    "fruits de mer": "shellfish",
+    "sesame": "sesame",
+    "mustard": "mustard",
+    "moutarde": "mustard",
+    "celery": "celery",
+    "celeri": "celery",
+    "lupin": "lupin",
+    "lupine": "lupin",
+    "sulfites": "sulphites",
+    "sulphites": "sulphites",
+    "sulfite": "sulphites",
+    "sulphite": "sulphites",
+}
+
+OBJECTIVE_SYNONYMS = {
+    "weight loss": "weight_loss",
+    "lose weight": "weight_loss",
+    "perte de poids": "weight_loss",
+    "perdre du poids": "weight_loss",
+    "maigrir": "weight_loss",
+    "weight gain": "weight_gain",
+    "gain weight": "weight_gain",
+    "prise de poids": "weight_gain",
+    "prendre du poids": "weight_gain",
+    "maintain weight": "weight_maintenance",
+    "weight maintenance": "weight_maintenance",
+    "maintenir mon poids": "weight_maintenance",
+    "maintien du poids": "weight_maintenance",
+    "muscle gain": "muscle_gain",
+    "gain muscle": "muscle_gain",
+    "prise de masse": "muscle_gain",
+    "eat healthy": "healthy_eating",
+    "healthy eating": "healthy_eating",
+    "manger sainement": "healthy_eating",
+}
+
+GENDER_SYNONYMS = {
+    "male": "male",
+    "m": "male",
+    "homme": "male",
+    "man": "male",
+    "female": "female",
+    "f": "female",
+    "femme": "female",
+    "woman": "female",
+}
+
+
+def normalize_term(term) -> str:
+    """Lowercase, strip accents and collapse separators"""
+    text = unidecode(str(term)).lower()
+    text = re.sub(r"[_\-]+", " ", text)
+    text = re.sub(r"\s+", " ", text)
+    return text.strip()
+
+
+def canonical_terms(values, synonyms: dict) -> list:
+    """Normalize, map synonyms, deduplicate and sort a list of free-text terms"""
+    terms = set()
+    for value in values or []:
+        if value is None:
+            continue
+        term = normalize_term(value)
+        if not term or term in ("none", "aucun", "aucune", "null"):
+            continue
+        terms.add(synonyms.get(term, term.replace(" ", "_")))
+    return sorted(terms)
+
+
+def band(value, bands) -> str:
+    if value is None:
+        return None
+    for upper, label in bands:
+        if value < upper:
+            return label
+    return bands[-1][1]
+
+
+def canonical_profile(user_data, strictness: str = DEFAULT_STRICTNESS) -> dict:
+    """
+    Map a user profile to the stable dict used in cache keys
+
+    Args:
+        user_data: UserData (or any object with the same attributes)
+        strictness (str): One of STRICTNESS_LEVELS
+
+    Returns:
+        dict: Only the fields the prompt uses, canonicalized for the given level
+    """
+    if strictness == "exact":
+        return {
+            "age": user_data.age,
+            "gender": user_data.gender,
+            "bmi": user_data.bmi,
+            "health_conditions": list(user_data.health_conditions or []),
+            "allergies": list(user_data.allergies or []),
+            "objectives": list(user_data.objectives or []),
+        }
+
+    gender = normalize_term(user_data.gender) if user_data.gender else None
+    profile = {
+        "gender": GENDER_SYNONYMS.get(gender, gender),
+        "health_conditions": canonical_terms(user_data.health_conditions, CONDITION_SYNONYMS),
+        "allergies": canonical_terms(user_data.allergies, ALLERGY_SYNONYMS),
+        "objectives": canonical_terms(user_data.objectives, OBJECTIVE_SYNONYMS),
+    }
+    # Only the BMI Spring Boot sends: the prompt shows "Not calculated" without it,
+    # so computing one from weight and height would split or merge keys the prompt doesn't
+    bmi = user_data.bmi or None
+    if strictness == "banded":
+        profile["age"] = band(user_data.age, AGE_BANDS)
+        profile["bmi"] = band(bmi, BMI_BANDS)
+    else:
+        profile["age"] = user_data.age
+        profile["bmi"] = round(bmi, 1) if bmi is not None else None
+    return profile
+
+
+def profile_key(user_data, strictness: str = DEFAULT_STRICTNESS) -> str:
+    raw = json.dumps(canonical_profile(user_data, strictness), sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ProfileKeyStats:
+    """
+    Counts how many distinct profiles live traffic collapses into at each strictness level.
+
+    Only the first `max_tracked` distinct keys per level are remembered, to bound memory.
+    """
+
+    def __init__(self, max_tracked: int = 100000):
+        self.max_tracked = max_tracked
+        self.requests = 0
+        self._keys = {level: set() for level in STRICTNESS_LEVELS}
+        self._lock = threading.Lock()
+
+    def record(self, user_data):
+        keys = {level: profile_key(user_data, level) for level in STRICTNESS_LEVELS}
+        with self._lock:
+            self.requests += 1
+            for level, key in keys.items():
+                seen = self._keys[level]
+                if len(seen) < self.max_tracked:
+                    seen.add(key)
+
+    def report(self) -> dict:
+        with self._lock:
+            distinct = {level: len(keys) for level, keys in self._keys.items()}
+            exact = distinct["exact"]
+            return {
+                "strictness": DEFAULT_STRICTNESS,
+                "profiles_seen": self.requests,
+                "distinct_keys": distinct,
+                "collapse_ratio": {
+                    level: round(exact / count, 2) if count else 0.0
+                    for level, count in distinct.items()
+                },
+                "capped": any(count >= self.max_tracked for count in distinct.values()),
+            }
+
+
+if __name__ == "__main__":
+    from types import SimpleNamespace
+
+    if len(sys.argv) != 2:
+        print("Usage: python profile_canonicalization.py profiles.jsonl")
+        sys.exit(1)
+
+    fields = ("age", "gender", "bmi", "weight", "height", "health_conditions", "allergies", "objectives")
+    stats = ProfileKeyStats(max_tracked=10 ** 9)
+    with open(sys.argv[1], "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            record = record.get("user_data", record)
+            stats.record(SimpleNamespace(**{field: record.get(field) for field in fields}))
+    print(json.dumps(stats.report(), indent=2))
@@ -0,0 +1,237 @@
+"""
+On-demand profiling of a running worker.
+
+A profiling session is started from /debug/profile/start and covers the next N
+requests or T seconds, whichever comes first. When no session is active the
+middleware only checks `profiler.active`, so the cost when off is one attribute read.
+
+Modes:
+- sampling (default): a background thread samples the event loop thread's stack
+  every `interval_ms` while requests are in flight. Gives collapsed stacks for
+  flame graphs and inclusive time per function (estimated from samples).
+- deterministic: cProfile is enabled on the event loop thread while requests are
+  in flight. Gives exact call counts and cumulative times, but no stacks, and slows
+  the profiled requests down noticeably.
+
+All session state changes happen on the event loop thread, except the sampler
+thread which only reads frames and appends to its own counters under a lock.
+"""
+import asyncio
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+PROFILE_MODES = ("sampling", "deterministic")
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class ProfileSession:
+    def __init__(self, mode: str, max_requests: int, max_seconds: float, interval_ms: float):
+        self.mode = mode
+        self.max_requests = max_requests
+        self.max_seconds = max_seconds
+        self.interval = interval_ms / 1000.0
+        self.started_at = datetime.now().isoformat()
+        self.start = time.monotonic()
+        self.deadline = self.start + max_seconds
+        self.requests_started = 0
+        self.requests_finished = 0
+        self.in_flight = 0
+        self.duration_s = None
+        self.stop_reason = None
+        self.loop_thread_id = threading.get_ident()
+        self.samples = Counter()
+        self.sample_count = 0
+        self._samples_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._sampler = None
+        self._profile = cProfile.Profile() if mode == "deterministic" else None
+
+    def begin(self):
+        if self.mode == "sampling":
+            self._sampler = threading.Thread(target=self._sample_loop, name="profile-sampler", daemon=True)
+            self._sampler.start()
+
+    def end(self, reason: str):
+        self.stop_reason = reason
+        self.duration_s = round(time.monotonic() - self.start, 3)
+        self._stop_event.set()
+        if self._profile is not None and self.in_flight > 0:
+            self._profile.disable()
+        if self._sampler is not None:
+            self._sampler.join(timeout=1.0)
+
+    def request_started(self):
+        self.requests_started += 1
+        self.in_flight += 1
+        if self._profile is not None and self.in_flight == 1:
+            self._profile.enable()
+
+    def request_finished(self):
+        self.requests_finished += 1
+        self.in_flight -= 1
+        if self._profile is not None and self.in_flight == 0:
+            self._profile.disable()
+
+    def _sample_loop(self):
+        while not self._stop_event.wait(self.interval):
+            if self.in_flight <= 0:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            stack.reverse()
+            with self._samples_lock:
+                self.samples[";".join(stack)] += 1
+                self.sample_count += 1
+
+    def collapsed_stacks(self) -> str:
+        """Brendan Gregg's collapsed format, usable with flamegraph.pl or speedscope"""
+        with self._samples_lock:
+            return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common())
+
+    def top_functions(self, limit: int = 30) -> list:
+        if self._profile is not None:
+            stats = pstats.Stats(self._profile).stats
+            rows = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+            return [
+                {
+                    "function": f"{func} ({os.path.basename(filename)}:{line})",
+                    "calls": nc,
+                    "total_time_ms": round(tt * 1000, 3),
+                    "cumulative_time_ms": round(ct * 1000, 3),
+                }
+                for (filename, line, func), (cc, nc, tt, ct, callers) in rows
+            ]
+
+        # Sampling: a function's cumulative time is the number of samples it appears in
+        inclusive = Counter()
+        self_samples = Counter()
+        with self._samples_lock:
+            for stack, count in self.samples.items():
+                frames = stack.split(";")
+                for label in set(frames):
+                    inclusive[label] += count
+                self_samples[frames[-1]] += count
+        return [
+            {
+                "function": label,
+                "samples": count,
+                "self_samples": self_samples[label],
+                "cumulative_time_ms": round(count * self.interval * 1000, 1),
+            }
+            for label, count in inclusive.most_common(limit)
+        ]
+
+    def summary(self, limit: int = 30) -> dict:
+        return {
+            "mode": self.mode,
+            "started_at": self.started_at,
+            "max_requests": self.max_requests,
+            "max_seconds": self.max_seconds,
+            "requests_profiled": self.requests_finished,
+            "duration_s": self.duration_s if self.duration_s is not None else round(time.monotonic() - self.start, 3),
+            "stop_reason": self.stop_reason,
+            "sample_count": self.sample_count if self.mode == "sampling" else None,
+            "top_functions": self.top_functions(limit),
+        }
+
+
+class Profiler:
+    def __init__(self):
+        self.active = None
+        self.last = None
+        self._deadline_timer = None
+
+    def start(self, mode: str, max_requests: int, max_seconds: float, interval_ms: float) -> ProfileSession:
+        """Start a session. Call from the event loop: the time limit is enforced by a timer on it"""
+        if self.active is not None:
+            raise RuntimeError("A profiling session is already running")
+        session = ProfileSession(mode, max_requests, max_seconds, interval_ms)
+        session.begin()
+        self.active = session
+        # Stop at the deadline even if no request comes in to notice it
+        self._deadline_timer = asyncio.get_running_loop().call_later(max_seconds, self._stop_at_deadline, session)
+        return session
+
+    def _stop_at_deadline(self, session: ProfileSession):
+        if session is self.active:
+            self.stop("time_limit")
+
+    def stop(self, reason: str = "stopped"):
+        session = self.active
+        if session is None:
+            return None
+        if self._deadline_timer is not None:
+            self._deadline_timer.cancel()
+            self._deadline_timer = None
+        self.active = None
+        session.end(reason)
+        self.last = session
+        return session
+
+    def request_started(self):
+        """Register a request with the active session. Returns the session, or None if the request is not profiled"""
+        session = self.active
+        if session is None:
+            return None
+        if time.monotonic() >= session.deadline:
+            self.stop("time_limit")
+            return None
+        if session.requests_started >= session.max_requests:
+            return None
+        session.request_started()
+        return session
+
+    def request_finished(self, session: ProfileSession):
+        # The session may have been stopped (time limit, manual stop) while the request was running
+        if session is not self.active:
+            return
+        session.request_finished()
+        if session.requests_finished >= session.max_requests:
+            self.stop("request_limit")
+
+    def current(self):
+        """The active session, or the last finished one"""
+        session = self.active
+        if session is not None and time.monotonic() >= session.deadline:
+            self.stop("time_limit")
+            session = None
+        return session or self.last
+
+
+profiler = Profiler()
+
+
+class ProfileMiddleware:
+    """ASGI middleware registering requests with the active profiling session; passes straight through when none is active"""
+
+    def __init__(self, app, skip_prefix: str = "/debug/profile"):
+        self.app = app
+        self.skip_prefix = skip_prefix
+
+    async def __call__(self, scope, receive, send):
+        if profiler.active is None or scope["type"] != "http" or scope["path"].startswith(self.skip_prefix):
+            await self.app(scope, receive, send)
+            return
+
+        session = profiler.request_started()
+        if session is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.request_finished(session)
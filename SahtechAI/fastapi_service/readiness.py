@@ -0,0 +1,81 @@
+import logging
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamProbe:
+    """Result of the last check of an upstream dependency, refreshed in the background"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.ok = None
+        self.latency_ms = None
+        self.checked_at = None
+        self.error = None
+        self.consecutive_failures = 0
+
+    def run(self, check) -> bool:
+        """Run `check` (a blocking callable that raises on failure) and record the outcome"""
+        start = time.perf_counter()
+        try:
+            check()
+            self.ok = True
+            self.error = None
+            self.consecutive_failures = 0
+        except Exception as e:
+            self.ok = False
+            self.consecutive_failures += 1
+            self.error = f"{type(e).__name__}: {e}"
+            logger.warning("Upstream probe %s failed: %s", self.name, self.error)
+        self.latency_ms = round((time.perf_counter() - start) * 1000, 1)
+        self.checked_at = datetime.now().isoformat()
+        return self.ok
+
+    def status(self) -> dict:
+        return {
+            "ok": self.ok,
+            "latency_ms": self.latency_ms,
+            "checked_at": self.checked_at,
+            "error": self.error,
+            "consecutive_failures": self.consecutive_failures,
+        }
+
+
+class WarmupState:
+    """Tracks the startup warm-up steps; the worker is warm once all of them ran"""
+
+    def __init__(self):
+        self.warm = False
+        self.started_at = None
+        self.duration_ms = None
+        self.steps = {}
+        self._start = None
+
+    def begin(self):
+        self.started_at = datetime.now().isoformat()
+        self._start = time.perf_counter()
+
+    def step(self, name: str, func):
+        """Run one warm-up step. A failing step is recorded but does not stop the warm-up"""
+        start = time.perf_counter()
+        try:
+            func()
+            self.steps[name] = {"ok": True}
+        except Exception as e:
+            logger.error("Warm-up step %s failed: %s", name, e)
+            self.steps[name] = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        self.steps[name]["duration_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+    def finish(self):
+        self.duration_ms = round((time.perf_counter() - self._start) * 1000, 1)
+        self.warm = True
+
+    def status(self) -> dict:
+        return {
+            "warm": self.warm,
+            "started_at": self.started_at,
+            "duration_ms": self.duration_ms,
+            "steps": self.steps,
+        }
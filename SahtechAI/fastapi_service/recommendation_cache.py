@@ -0,0 +1,397 @@
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from profile_canonicalization import DEFAULT_STRICTNESS, canonical_profile
+
+logger = logging.getLogger(__name__)
+
+# Bump this when the prompt or the key layout changes so old warm-cache files are ignored
+CACHE_KEY_VERSION = 3
+
+# Profile fields of the archetype-level key used by the warm cache
+ARCHETYPE_FIELDS = ("health_conditions", "allergies", "objectives")
+
+# E-numbers as written on labels: "E150d", "E 330", "e-471"
+E_NUMBER_PATTERN = re.compile(r"\bE\s?-?(\d{3,4}[a-z]?)\b", re.IGNORECASE)
+
+
+def build_cache_key(user_data, product_data, strictness: str = DEFAULT_STRICTNESS) -> str:
+    """
+    Build the cache key for a (user profile, product) pair.
+
+    Only the fields that end up in the prompt are part of the key. The user
+    profile is canonicalized (see profile_canonicalization.py) so similar
+    users share an entry.
+    """
+    key_data = {
+        "v": CACHE_KEY_VERSION,
+        "strictness": strictness,
+        "user": canonical_profile(user_data, strictness),
+        "product": _product_key_data(product_data),
+    }
+    raw = json.dumps(key_data, sort_keys=True, ensure_ascii=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def build_archetype_key(user_data, product_data) -> str:
+    """
+    Coarser key the warm cache is stored under: only the canonical conditions,
+    allergies and objectives of the profile, no age, gender or BMI.
+
+    Pre-generated archetypes can't match every age/BMI/gender band of real users,
+    so a full-key miss falls back to this key (see RecommendationCache.get).
+    """
+    profile = canonical_profile(user_data, "normalized")
+    key_data = {
+        "v": CACHE_KEY_VERSION,
+        "archetype": {field: profile[field] for field in ARCHETYPE_FIELDS},
+        "product": _product_key_data(product_data),
+    }
+    raw = json.dumps(key_data, sort_keys=True, ensure_ascii=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _product_key_data(product_data) -> dict:
+    return {
+        "barcode": product_data.barcode,
+        "name": product_data.name,
+        "brand": product_data.brand,
+        "category": product_data.category,
+        "nutri_score": product_data.nutri_score,
+        "ingredients": list(product_data.ingredients or []),
+        "additives": list(product_data.additives or []),
+    }
+
+
+def additive_codes(values) -> list:
+    """Normalized E-numbers ("E150D") mentioned in a list of additives or ingredients"""
+    codes = set()
+    for value in values or []:
+        for match in E_NUMBER_PATTERN.finditer(str(value)):
+            codes.add(f"E{match.group(1).upper()}")
+    return sorted(codes)
+
+
+def cache_dependencies(user_data, product_data) -> dict:
+    """What a cached recommendation depends on, used to find it again on invalidation"""
+    return {
+        "user_id": user_data.user_id,
+        "barcode": product_data.barcode,
+        "additives": additive_codes(list(product_data.additives or []) + list(product_data.ingredients or [])),
+    }
+
+
+class RecommendationCache:
+    """
+    Thread-safe LRU cache of generated recommendations.
+
+    Entries loaded from the warm-cache file are pinned: they are never evicted
+    by live traffic, so the top products stay served without calling Groq. They
+    are stored under archetype keys and only found through get()'s fallback key.
+
+    Reverse indexes from user_id, barcode and E-number to cache keys let a
+    change to one of them evict only the entries that depended on it.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._pinned = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.archetype_hits = 0
+        # key -> (user_data, product_data) of the last request that produced it, for regeneration
+        self._sources = {}
+        self._by_user = {}
+        self._by_barcode = {}
+        self._by_additive = {}
+        self._key_deps = {}
+        self.invalidations = {"user": 0, "product": 0, "additive": 0}
+        self.invalidated_entries = 0
+        self.invalidation_ms_total = 0.0
+        self.invalidation_ms_max = 0.0
+
+    def get(self, key: str, fallback_key: str = None):
+        """
+        Look up a recommendation by its full key, then by `fallback_key` among the
+        pinned warm-cache entries (see build_archetype_key)
+        """
+        with self._lock:
+            if key in self._pinned:
+                self.hits += 1
+                return self._pinned[key]
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            if fallback_key is not None and fallback_key in self._pinned:
+                self.hits += 1
+                self.archetype_hits += 1
+                return self._pinned[fallback_key]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, recommendation: str, pinned: bool = False, dependencies: dict = None, source=None):
+        """
+        Store a recommendation
+
+        Args:
+            key (str): Cache key from build_cache_key
+            recommendation (str): Generated recommendation text
+            pinned (bool): Never evict this entry on LRU pressure (warm cache)
+            dependencies (dict): user_id, barcode and additives the entry depends on (see cache_dependencies)
+            source: (user_data, product_data) to regenerate the entry from after an invalidation
+        """
+        with self._lock:
+            if dependencies:
+                self._index(key, dependencies)
+            if source is not None:
+                self._sources[key] = source
+            if pinned:
+                self._entries.pop(key, None)
+                self._pinned[key] = recommendation
+                return
+            if key in self._pinned:
+                return
+            self._entries[key] = recommendation
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                self._unindex(evicted)
+
+    def link_user(self, key: str, user_id: str):
+        """Record that this user was served a cached entry, so invalidating another user sharing it keeps it"""
+        with self._lock:
+            # Pinned entries were generated for archetypes, not for any user
+            if user_id and key in self._entries:
+                self._index(key, {"user_id": user_id})
+
+    def _index(self, key: str, dependencies: dict):
+        deps = self._key_deps.setdefault(key, {"users": set(), "barcode": None, "additives": ()})
+        user_id = dependencies.get("user_id")
+        if user_id:
+            deps["users"].add(user_id)
+            self._by_user.setdefault(user_id, set()).add(key)
+        if dependencies.get("barcode"):
+            deps["barcode"] = dependencies["barcode"]
+            self._by_barcode.setdefault(deps["barcode"], set()).add(key)
+        if dependencies.get("additives"):
+            deps["additives"] = tuple(dependencies["additives"])
+            for code in deps["additives"]:
+                self._by_additive.setdefault(code, set()).add(key)
+
+    def _unindex(self, key: str):
+        self._sources.pop(key, None)
+        deps = self._key_deps.pop(key, None)
+        if not deps:
+            return
+        for index, values in ((self._by_user, deps["users"]), (self._by_barcode, [deps["barcode"]]), (self._by_additive, deps["additives"])):
+            for value in values:
+                keys = index.get(value)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del index[value]
+
+    def _evict(self, keys) -> list:
+        """Remove entries and return the (user_data, product_data) sources of those that had one"""
+        sources = []
+        for key in keys:
+            self._entries.pop(key, None)
+            self._pinned.pop(key, None)
+            source = self._sources.get(key)
+            if source is not None:
+                sources.append(source)
+            self._unindex(key)
+        return sources
+
+    def _record_invalidation(self, kind: str, count: int, start: float) -> float:
+        duration_ms = (time.perf_counter() - start) * 1000
+        self.invalidations[kind] += 1
+        self.invalidated_entries += count
+        self.invalidation_ms_total += duration_ms
+        self.invalidation_ms_max = max(self.invalidation_ms_max, duration_ms)
+        return round(duration_ms, 3)
+
+    def invalidate_user(self, user_id: str) -> dict:
+        """
+        Drop a user's cached recommendations after their profile changed.
+
+        Keys are built from the canonical profile, so an entry can be shared with
+        other users whose profile maps to the same key: those stay cached for them,
+        only entries no other user depends on are evicted. Pinned warm-cache entries
+        are never evicted by a user invalidation.
+        """
+        start = time.perf_counter()
+        with self._lock:
+            keys = self._by_user.pop(user_id, set())
+            orphaned = []
+            for key in keys:
+                users = self._key_deps[key]["users"]
+                users.discard(user_id)
+                if not users and key not in self._pinned:
+                    orphaned.append(key)
+            sources = self._evict(orphaned)
+            duration_ms = self._record_invalidation("user", len(orphaned), start)
+        return {"invalidated": len(orphaned), "kept_shared": len(keys) - len(orphaned), "duration_ms": duration_ms, "sources": sources}
+
+    def invalidate_product(self, barcode: str) -> dict:
+        """Evict every entry generated for this barcode, e.g. after its ingredients were corrected"""
+        start = time.perf_counter()
+        with self._lock:
+            keys = list(self._by_barcode.get(barcode, ()))
+            sources = self._evict(keys)
+            duration_ms = self._record_invalidation("product", len(keys), start)
+        return {"invalidated": len(keys), "duration_ms": duration_ms, "sources": sources}
+
+    def invalidate_additives(self, codes) -> dict:
+        """Evict every entry whose product contains one of these E-numbers, e.g. after their risk data changed"""
+        start = time.perf_counter()
+        with self._lock:
+            keys = set()
+            for code in additive_codes(codes):
+                keys |= self._by_additive.get(code, set())
+            sources = self._evict(keys)
+            duration_ms = self._record_invalidation("additive", len(keys), start)
+        return {"invalidated": len(keys), "duration_ms": duration_ms, "sources": sources}
+
+    def load_warm_file(self, path: str) -> int:
+        """
+        Load a warm-cache file produced by pregenerate.py
+
+        Args:
+            path (str): Path of the warm-cache JSON file
+
+        Returns:
+            int: Number of entries loaded
+        """
+        if not os.path.exists(path):
+            logger.info("No warm cache file found at %s", path, extra={"event": "warm_cache.missing"})
+            return 0
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error("Error reading warm cache file %s: %s", path, e, extra={"event": "warm_cache.error"})
+            return 0
+
+        if data.get("key_version") != CACHE_KEY_VERSION:
+            logger.warning("Ignoring warm cache %s: key version %s != %s", path, data.get("key_version"), CACHE_KEY_VERSION, extra={"event": "warm_cache.ignored"})
+            return 0
+        if data.get("strictness") != DEFAULT_STRICTNESS:
+            logger.warning("Ignoring warm cache %s: generated with strictness %s, service uses %s", path, data.get("strictness"), DEFAULT_STRICTNESS, extra={"event": "warm_cache.ignored"})
+            return 0
+
+        entries = data.get("entries", {})
+        for key, entry in entries.items():
+            dependencies = {"barcode": entry.get("barcode"), "additives": entry.get("additives", [])}
+            self.put(key, entry["recommendation"], pinned=True, dependencies=dependencies)
+        logger.info("Loaded %d warm cache entries from %s", len(entries), path, extra={"event": "warm_cache.loaded"})
+        return len(entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            invalidation_count = sum(self.invalidations.values())
+            return {
+                "entries": len(self._entries),
+                "pinned_entries": len(self._pinned),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "archetype_hits": self.archetype_hits,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "invalidation": {
+                    "requests": dict(self.invalidations),
+                    "entries_invalidated": self.invalidated_entries,
+                    "avg_ms": round(self.invalidation_ms_total / invalidation_count, 3) if invalidation_count else 0.0,
+                    "max_ms": round(self.invalidation_ms_max, 3),
+                    "indexed_users": len(self._by_user),
+                    "indexed_barcodes": len(self._by_barcode),
+                    "indexed_additives": len(self._by_additive),
+                },
+            }
+
+
+class CacheRegenerator:
+    """
+    Re-generates invalidated entries in the background, at low priority.
+
+    A single daemon thread works through a bounded queue, spacing calls to at
+    most `rate` per second so it never competes with live traffic for the Groq
+    rate limit. Work that doesn't fit in the queue is dropped: the entry is then
+    simply regenerated by the next live request.
+    """
+
+    def __init__(self, generate, rate: float = 1.0, max_queue: int = 1000):
+        self.generate = generate
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.dropped = 0
+        self.regenerated = 0
+        self.failed = 0
+
+    def submit(self, sources) -> int:
+        """Queue (user_data, product_data) pairs for regeneration, returns how many were queued"""
+        self._ensure_started()
+        queued = 0
+        for source in sources:
+            try:
+                self._queue.put_nowait(source)
+                queued += 1
+            except queue.Full:
+                self.dropped += 1
+        self.queued += queued
+        return queued
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="cache-regenerator", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            user_data, product_data = self._queue.get()
+            try:
+                self.generate(user_data, product_data)
+                self.regenerated += 1
+            except Exception as e:
+                self.failed += 1
+                logger.warning("Regenerating recommendation for %s failed: %s", product_data.barcode, e, extra={"event": "cache.regenerate_failed"})
+            time.sleep(self.interval)
+
+    def stats(self) -> dict:
+        return {
+            "pending": self._queue.qsize(),
+            "queued": self.queued,
+            "dropped": self.dropped,
+            "regenerated": self.regenerated,
+            "failed": self.failed,
+        }
+
+
+def save_warm_file(path: str, entries: dict):
+    """Atomically write a warm-cache file so the service never reads a half-written one"""
+    data = {
+        "key_version": CACHE_KEY_VERSION,
+        "strictness": DEFAULT_STRICTNESS,
+        "generated_at": datetime.now().isoformat(),
+        "entries": entries,
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
@@ -0,0 +1,77 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class AdditiveReference:
+    """
+    Additive reference data scraped from the web sources, kept in memory.
+
+    Loaded once at startup and refreshed in the background every `max_age_seconds`,
+    instead of scraping both sources for every prompt. When a refresh changes
+    previously loaded data, `on_change` is called with the added and removed entries.
+    """
+
+    def __init__(self, fetch, urls: list, max_age_seconds: float, on_change=None):
+        self.fetch = fetch
+        self.on_change = on_change
+        self.urls = urls
+        self.max_age_seconds = max_age_seconds
+        self.sources = {url: [] for url in urls}
+        self.loaded_at = None
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def refresh(self) -> bool:
+        """
+        Scrape all sources again. A source that comes back empty keeps its previous data.
+
+        Returns:
+            bool: True if at least one source returned data
+        """
+        fetched = {url: self.fetch(url) for url in self.urls}
+        changed = []
+        with self._lock:
+            for url, items in fetched.items():
+                if items:
+                    if self.sources[url]:
+                        changed.extend(set(items) ^ set(self.sources[url]))
+                    self.sources[url] = items
+                else:
+                    logger.warning("Additive source %s returned no data, keeping %d previous entries", url, len(self.sources[url]))
+            if any(fetched.values()):
+                self.loaded_at = time.time()
+                self.last_error = None
+            else:
+                self.last_error = "all sources returned no data"
+        if changed and self.on_change:
+            self.on_change(changed)
+        return self.last_error is None
+
+    def get(self, url: str) -> list:
+        if self.loaded_at is None and not any(self.sources.values()):
+            # Not loaded yet (warm-up still running or failed): load on first use
+            self.refresh()
+        with self._lock:
+            return self.sources.get(url, [])
+
+    def age_seconds(self):
+        if self.loaded_at is None:
+            return None
+        return round(time.time() - self.loaded_at, 1)
+
+    def is_stale(self) -> bool:
+        age = self.age_seconds()
+        return age is None or age >= self.max_age_seconds
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "loaded": self.loaded_at is not None,
+                "age_seconds": self.age_seconds(),
+                "max_age_seconds": self.max_age_seconds,
+                "entries": {url: len(items) for url, items in self.sources.items()},
+                "last_error": self.last_error,
+            }
@@ -0,0 +1,214 @@
+"""
+Replay captured traffic against a running instance and compare two builds.
+
+Usage:
+    python replay.py run capture.*.msgpack --target http://localhost:8000 --output build_a.jsonl
+    python replay.py run capture.*.msgpack --target http://localhost:8001 --speed 4 --output build_b.jsonl
+    python replay.py diff build_a.jsonl build_b.jsonl
+
+`run` re-sends the requests of one or more capture files (see traffic_capture.py,
+one file per worker process) in arrival order, keeping the gaps between them,
+divided by --speed (1 = real time, 0 = as fast as possible). Requests are sent open-loop: a slow server does not slow the schedule down, up to
+--max-in-flight concurrent requests. One result line per request is written to
+--output.
+
+`diff` matches the results of two runs of the same capture by request index and
+reports latency percentiles per endpoint and which recommendation types changed.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import sys
+import time
+from collections import Counter
+
+import httpx
+
+from traffic_capture import read_capture
+
+logger = logging.getLogger("replay")
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def percentile(sorted_values: list, p: float):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def latency_summary(results: list) -> dict:
+    """Latency percentiles and error count per endpoint"""
+    by_path = {}
+    for result in results:
+        by_path.setdefault(result["path"], []).append(result)
+    summary = {}
+    for path, items in sorted(by_path.items()):
+        latencies = sorted(r["latency_ms"] for r in items if r.get("latency_ms") is not None)
+        summary[path] = {
+            "requests": len(items),
+            "errors": sum(1 for r in items if r.get("error") or (r.get("status") or 0) >= 400),
+            "mean_ms": round(sum(latencies) / len(latencies), 1) if latencies else None,
+            **{f"p{p}_ms": percentile(latencies, p) for p in PERCENTILES},
+            "max_ms": latencies[-1] if latencies else None,
+        }
+    return summary
+
+
+async def send_one(client: httpx.AsyncClient, index: int, record: dict, api_key: str) -> dict:
+    result = {"index": index, "path": record["path"], "captured_status": record.get("status"), "captured_ms": record.get("ms")}
+    start = time.perf_counter()
+    try:
+        response = await client.post(record["path"], json=record["body"], headers={"X-API-Key": api_key} if api_key else {})
+        result["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        result["status"] = response.status_code
+        if record["path"] == "/predict" and response.status_code == 200:
+            result["recommendation_type"] = response.json().get("recommendation_type")
+    except Exception as e:
+        result["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        result["status"] = None
+        result["error"] = f"{type(e).__name__}: {e}"
+    return result
+
+
+async def replay(records: list, target: str, speed: float, api_key: str, max_in_flight: int, timeout: float) -> list:
+    semaphore = asyncio.Semaphore(max_in_flight)
+    first_ts = records[0]["ts"] if records else 0.0
+
+    async def scheduled(client, index, record, due):
+        async with semaphore:
+            # How far behind schedule the request went out (client side, e.g. max_in_flight reached)
+            late_ms = round(max(0.0, time.perf_counter() - due) * 1000, 1)
+            result = await send_one(client, index, record, api_key)
+        result["late_ms"] = late_ms
+        return result
+
+    limits = httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight)
+    async with httpx.AsyncClient(base_url=target, timeout=timeout, limits=limits) as client:
+        tasks = []
+        start = time.perf_counter()
+        for index, record in enumerate(records):
+            due = start + ((record["ts"] - first_ts) / speed if speed > 0 else 0.0)
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(scheduled(client, index, record, due)))
+            if (index + 1) % 500 == 0:
+                logger.info("Sent %d/%d requests", index + 1, len(records))
+        return list(await asyncio.gather(*tasks))
+
+
+def run(args) -> int:
+    records = [r for path in args.capture for r in read_capture(path) if not args.paths or r["path"] in args.paths]
+    # Files are in completion order (and one per worker): replay in arrival order
+    records.sort(key=lambda r: r["ts"])
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        logger.error("No records to replay in %s", ", ".join(args.capture))
+        return 1
+    span_seconds = records[-1]["ts"] - records[0]["ts"]
+    logger.info("Replaying %d requests spanning %.0fs against %s at %sx", len(records), span_seconds, args.target, args.speed)
+
+    results = asyncio.run(replay(records, args.target, args.speed, args.api_key, args.max_in_flight, args.timeout))
+    with open(args.output, "w", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+
+    print(json.dumps({
+        "requests": len(results),
+        "late_requests": sum(1 for r in results if r["late_ms"] > 100),
+        "latency": latency_summary(results),
+        "recommendation_types": dict(Counter(r["recommendation_type"] for r in results if r.get("recommendation_type"))),
+    }, indent=2))
+    logger.info("Wrote %d results to %s", len(results), args.output)
+    return 0
+
+
+def load_results(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return {r["index"]: r for r in (json.loads(line) for line in f if line.strip())}
+
+
+def diff(args) -> int:
+    before = load_results(args.before)
+    after = load_results(args.after)
+    common = sorted(before.keys() & after.keys())
+    if len(common) != len(before) or len(common) != len(after):
+        logger.warning("Results don't cover the same requests (%d vs %d), comparing %d in common", len(before), len(after), len(common))
+
+    latency_before = latency_summary([before[i] for i in common])
+    latency_after = latency_summary([after[i] for i in common])
+    latency = {}
+    regressions = []
+    for path in sorted(latency_before.keys() | latency_after.keys()):
+        a, b = latency_before.get(path, {}), latency_after.get(path, {})
+        latency[path] = {}
+        for stat in ["mean_ms"] + [f"p{p}_ms" for p in PERCENTILES] + ["max_ms", "errors"]:
+            old, new = a.get(stat), b.get(stat)
+            change = round((new - old) / old * 100, 1) if old and new is not None else None
+            latency[path][stat] = {"before": old, "after": new, "change_pct": change}
+        p95_change = latency[path]["p95_ms"]["change_pct"]
+        if args.max_p95_regression is not None and p95_change is not None and p95_change > args.max_p95_regression:
+            regressions.append(f"{path} p95 {p95_change:+.1f}%")
+
+    # Recommendation types, for the /predict requests that succeeded in both runs
+    typed = [i for i in common if before[i].get("recommendation_type") and after[i].get("recommendation_type")]
+    transitions = Counter(
+        f"{before[i]['recommendation_type']} -> {after[i]['recommendation_type']}"
+        for i in typed
+        if before[i]["recommendation_type"] != after[i]["recommendation_type"]
+    )
+    changed = sum(transitions.values())
+    report = {
+        "requests_compared": len(common),
+        "latency": latency,
+        "recommendation_types": {
+            "compared": len(typed),
+            "changed": changed,
+            "changed_pct": round(changed / len(typed) * 100, 2) if typed else 0.0,
+            "before": dict(Counter(before[i]["recommendation_type"] for i in typed)),
+            "after": dict(Counter(after[i]["recommendation_type"] for i in typed)),
+            "transitions": dict(transitions.most_common()),
+        },
+    }
+    print(json.dumps(report, indent=2))
+    if regressions:
+        logger.error("Latency regressions above %s%%: %s", args.max_p95_regression, ", ".join(regressions))
+        return 1
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay captured traffic and compare builds")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Replay a capture file against a running instance")
+    run_parser.add_argument("capture", nargs="+", help="Capture files written with TRAFFIC_CAPTURE_FILE (one per worker)")
+    run_parser.add_argument("--target", default="http://localhost:8000", help="Base URL of the instance to test")
+    run_parser.add_argument("--output", required=True, help="JSON lines file to write the results to")
+    run_parser.add_argument("--speed", type=float, default=1.0, help="Replay speed factor (1 = real time, 0 = no delays)")
+    run_parser.add_argument("--api-key", default=os.environ.get("API_KEY"), help="X-API-Key of the target (default: $API_KEY)")
+    run_parser.add_argument("--paths", nargs="*", help="Only replay these endpoints, e.g. /predict")
+    run_parser.add_argument("--limit", type=int, help="Only replay the first N requests")
+    run_parser.add_argument("--max-in-flight", type=int, default=100, help="Max concurrent requests")
+    run_parser.add_argument("--timeout", type=float, default=60.0, help="Request timeout in seconds")
+    run_parser.set_defaults(func=run)
+
+    diff_parser = commands.add_parser("diff", help="Compare the results of two replays of the same capture")
+    diff_parser.add_argument("before", help="Results of the baseline build")
+    diff_parser.add_argument("after", help="Results of the new build")
+    diff_parser.add_argument("--max-p95-regression", type=float, help="Exit with 1 if any endpoint's p95 got worse by more than this percentage")
+    diff_parser.set_defaults(func=diff)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    args = parse_args()
+    sys.exit(args.func(args))
@@ -0,0 +1,220 @@
+"""
+Lightweight per-request tracing.
+
+A Trace is opened by the tracing middleware for each traced request and stored in
+a context variable; code on the request path wraps its stages in `with span("name"):`.
+Outside of a traced request span() does nothing.
+
+Finished traces are kept if they were sampled (TRACE_SAMPLE_RATE) or if they were
+slower than TRACE_SLOW_MS, in which case they are always kept. Kept traces go to an
+in-memory ring buffer (served by /debug/traces) and, if TRACE_LOG_FILE is set, to a
+rotating JSON lines file.
+"""
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from starlette.datastructures import Headers, MutableHeaders
+
+logger = logging.getLogger(__name__)
+
+TRACE_HEADER = "X-Trace-Id"
+# Incoming trace ids are only reused if they look like an id, otherwise a new one is generated
+TRACE_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+_current_trace = ContextVar("current_trace", default=None)
+
+
+class Trace:
+    def __init__(self, trace_id: str, name: str):
+        self.trace_id = trace_id
+        self.name = name
+        self.started_at = datetime.now().isoformat()
+        self.start = time.perf_counter()
+        self.duration_ms = None
+        self.spans = []
+        self.attributes = {}
+
+    def add_span(self, name: str, start: float, end: float, error: str = None):
+        span_data = {
+            "name": name,
+            "offset_ms": round((start - self.start) * 1000, 2),
+            "duration_ms": round((end - start) * 1000, 2),
+        }
+        if error:
+            span_data["error"] = error
+        self.spans.append(span_data)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": self.duration_ms,
+            "attributes": self.attributes,
+            "spans": self.spans,
+        }
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def current_trace_id():
+    trace = _current_trace.get()
+    return trace.trace_id if trace else None
+
+
+@contextmanager
+def span(name: str):
+    """Time a stage of the current request. No-op when the request is not traced"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        trace.add_span(name, start, time.perf_counter(), error=type(e).__name__)
+        raise
+    trace.add_span(name, start, time.perf_counter())
+
+
+def mark_span(name: str, since: float = None):
+    """Record a span that started earlier (default: at the start of the trace) and ends now"""
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    trace.add_span(name, trace.start if since is None else since, time.perf_counter())
+
+
+def set_attribute(key: str, value):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes[key] = value
+
+
+class Tracer:
+    def __init__(self, sample_rate: float, slow_threshold_ms: float, buffer_size: int = 200, log_file: str = None):
+        self.sample_rate = sample_rate
+        self.slow_threshold_ms = slow_threshold_ms
+        self._recent = deque(maxlen=buffer_size)
+        self._slow = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+        self.started = 0
+        self.recorded = 0
+        self.slow = 0
+        self._file_logger = None
+        self._file_listener = None
+        if log_file:
+            # File writes happen on a background thread so the request path never waits on disk
+            file_handler = RotatingFileHandler(log_file, maxBytes=10 * 1024 * 1024, backupCount=5)
+            file_handler.setFormatter(logging.Formatter("%(message)s"))
+            trace_queue = queue.SimpleQueue()
+            file_logger = logging.getLogger("sahtech.traces")
+            file_logger.propagate = False
+            file_logger.setLevel(logging.INFO)
+            file_logger.addHandler(QueueHandler(trace_queue))
+            self._file_listener = QueueListener(trace_queue, file_handler)
+            self._file_listener.start()
+            self._file_logger = file_logger
+
+    def start(self, name: str, trace_id: str = None):
+        """Open a trace for the current context and return (trace, token) for finish()"""
+        if not trace_id or not TRACE_ID_PATTERN.match(trace_id):
+            trace_id = uuid.uuid4().hex
+        trace = Trace(trace_id, name)
+        token = _current_trace.set(trace)
+        with self._lock:
+            self.started += 1
+        return trace, token
+
+    def finish(self, trace: Trace, token):
+        _current_trace.reset(token)
+        trace.duration_ms = round((time.perf_counter() - trace.start) * 1000, 2)
+        is_slow = trace.duration_ms >= self.slow_threshold_ms
+        if not is_slow and random.random() >= self.sample_rate:
+            return
+        record = trace.to_dict()
+        record["slow"] = is_slow
+        with self._lock:
+            self.recorded += 1
+            self._recent.append(record)
+            if is_slow:
+                self.slow += 1
+                self._slow.append(record)
+        if is_slow:
+            logger.warning("Slow request %s took %sms (trace %s)", trace.name, trace.duration_ms, trace.trace_id, extra={"event": "trace.slow"})
+        if self._file_logger:
+            self._file_logger.info(json.dumps(record))
+
+    def get(self, trace_id: str):
+        with self._lock:
+            for record in list(self._slow) + list(self._recent):
+                if record["trace_id"] == trace_id:
+                    return record
+        return None
+
+    def snapshot(self, slow_only: bool = False, limit: int = 50) -> dict:
+        with self._lock:
+            source = self._slow if slow_only else self._recent
+            traces = list(source)[-limit:][::-1]
+            return {
+                "sample_rate": self.sample_rate,
+                "slow_threshold_ms": self.slow_threshold_ms,
+                "traces_started": self.started,
+                "traces_recorded": self.recorded,
+                "slow_traces": self.slow,
+                "traces": traces,
+            }
+
+
+class TraceMiddleware:
+    """
+    ASGI middleware opening a trace for requests to `paths`.
+
+    Other paths go straight to the app, without any wrapping.
+    """
+
+    def __init__(self, app, paths):
+        self.app = app
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        # Reuse the trace id sent by Spring Boot so both sides can be correlated
+        trace, token = tracer.start(scope["path"], Headers(scope=scope).get(TRACE_HEADER))
+
+        async def send_with_trace_id(message):
+            if message["type"] == "http.response.start":
+                trace.attributes["status_code"] = message["status"]
+                MutableHeaders(scope=message)[TRACE_HEADER] = trace.trace_id
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        finally:
+            tracer.finish(trace, token)
+
+
+tracer = Tracer(
+    sample_rate=float(os.environ.get("TRACE_SAMPLE_RATE", 0.1)),
+    slow_threshold_ms=float(os.environ.get("TRACE_SLOW_MS", 2000)),
+    buffer_size=int(os.environ.get("TRACE_BUFFER_SIZE", 200)),
+    log_file=os.environ.get("TRACE_LOG_FILE") or None,
+)
@@ -0,0 +1,203 @@
+"""
+Opt-in capture of anonymized production traffic, for replay with replay.py.
+
+When TRAFFIC_CAPTURE_FILE is set, /predict and /normalize requests are appended
+as a stream of msgpack records to that file, with the process id added to its name
+(capture.msgpack -> capture.<pid>.msgpack) so several workers never write to the
+same file:
+
+    {"ts": 1760000000.123, "path": "/predict", "status": 200, "ms": 812.4, "body": {...}}
+
+The request path only copies the body bytes onto a queue; a background thread
+anonymizes, encodes and appends the records. Records are written when their request
+finishes, so a file is in completion order; replay.py sorts them by arrival (ts).
+Anonymization:
+- every "user_id" is replaced by a hash salted with TRAFFIC_CAPTURE_SALT (the same
+  user keeps the same hash in every worker's file and across restarts, so per-user
+  patterns and duplicate scans survive)
+- flutter_callback_url is dropped, a replay must not call the app back
+- with TRAFFIC_CAPTURE_REDACT (default true), free text (product name, brand,
+  descriptions, and every string sent to /normalize) is replaced by a hash token
+  of the same length. Allergies, conditions, ingredients and additives are kept:
+  they drive the recommendation and the cache keys.
+
+Environment variables:
+- TRAFFIC_CAPTURE_FILE: file to append to, suffixed with the pid (capture is off when unset)
+- TRAFFIC_CAPTURE_SALT: salt of the user_id hash, shared by all workers (required, capture
+  stays off without it)
+- TRAFFIC_CAPTURE_REDACT: "false" to keep free text
+- TRAFFIC_CAPTURE_SAMPLE_RATE: fraction of requests captured (default 1.0)
+- TRAFFIC_CAPTURE_MAX_BYTES: stop capturing once the file reaches this size (default 512 MB)
+"""
+import atexit
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+import msgpack
+
+logger = logging.getLogger(__name__)
+
+TRAFFIC_CAPTURE_FILE = os.environ.get("TRAFFIC_CAPTURE_FILE")
+TRAFFIC_CAPTURE_SALT = os.environ.get("TRAFFIC_CAPTURE_SALT")
+TRAFFIC_CAPTURE_REDACT = os.environ.get("TRAFFIC_CAPTURE_REDACT", "true").lower() in ("1", "true", "yes")
+TRAFFIC_CAPTURE_SAMPLE_RATE = float(os.environ.get("TRAFFIC_CAPTURE_SAMPLE_RATE", 1.0))
+TRAFFIC_CAPTURE_MAX_BYTES = int(os.environ.get("TRAFFIC_CAPTURE_MAX_BYTES", 512 * 1024 * 1024))
+
+CAPTURED_PATHS = ("/predict", "/normalize")
+# Larger bodies are not captured
+MAX_CAPTURED_BODY_BYTES = 256 * 1024
+
+FREE_TEXT_FIELDS = {"name", "brand", "description", "nutri_score_description"}
+DROPPED_FIELDS = {"flutter_callback_url"}
+
+
+def capture_path(path: str, pid: int = None) -> str:
+    """Per-process capture file: capture.msgpack -> capture.<pid>.msgpack"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{pid or os.getpid()}{ext}"
+
+
+def hash_token(value: str, salt: str, length: int = 16) -> str:
+    digest = hashlib.sha256(f"{salt}:{value}".encode("utf-8")).hexdigest()
+    return (digest * (length // len(digest) + 1))[:length]
+
+
+def anonymize(value, salt: str, redact: bool, redact_all_text: bool = False, key: str = None):
+    """Copy of a request body with user ids hashed and, if `redact`, free text replaced"""
+    if isinstance(value, dict):
+        return {
+            k: anonymize(v, salt, redact, redact_all_text, k)
+            for k, v in value.items()
+            if k not in DROPPED_FIELDS
+        }
+    if isinstance(value, list):
+        return [anonymize(item, salt, redact, redact_all_text, key) for item in value]
+    if isinstance(value, str):
+        if key == "user_id":
+            return "u_" + hash_token(value, salt)
+        if redact and (redact_all_text or key in FREE_TEXT_FIELDS):
+            return hash_token(value, salt, len(value))
+    return value
+
+
+class TrafficRecorder:
+    """Appends captured requests to the capture file from a background thread"""
+
+    def __init__(self, path: str, salt: str = TRAFFIC_CAPTURE_SALT, redact: bool = TRAFFIC_CAPTURE_REDACT,
+                 sample_rate: float = TRAFFIC_CAPTURE_SAMPLE_RATE, max_bytes: int = TRAFFIC_CAPTURE_MAX_BYTES):
+        if not salt:
+            # A random per-process salt would give the same user a different hash in each worker's file
+            raise ValueError("Traffic capture needs a salt shared by all workers (TRAFFIC_CAPTURE_SALT)")
+        self.path = capture_path(path)
+        self.salt = salt
+        self.redact = redact
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.captured = 0
+        self.skipped = 0
+        self.full = False
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="traffic-capture", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        logger.info("Capturing %s traffic to %s (redact=%s, sample_rate=%s)", ", ".join(CAPTURED_PATHS), self.path, redact, sample_rate)
+
+    def should_capture(self) -> bool:
+        return not self.full and random.random() < self.sample_rate
+
+    def record(self, ts: float, path: str, status: int, duration_ms: float, body: bytes):
+        self._queue.put((ts, path, status, duration_ms, body))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+    def _run(self):
+        with open(self.path, "ab") as f:
+            size = f.tell()
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                ts, path, status, duration_ms, body = item
+                try:
+                    data = json.loads(body)
+                except Exception:
+                    self.skipped += 1
+                    continue
+                packed = msgpack.packb({
+                    "ts": round(ts, 4),
+                    "path": path,
+                    "status": status,
+                    "ms": round(duration_ms, 1),
+                    "body": anonymize(data, self.salt, self.redact, redact_all_text=path == "/normalize"),
+                }, use_bin_type=True)
+                if size + len(packed) > self.max_bytes:
+                    self.full = True
+                    logger.warning("Traffic capture file %s reached %d bytes, capture stopped", self.path, self.max_bytes)
+                    return
+                f.write(packed)
+                size += len(packed)
+                self.captured += 1
+                if self._queue.empty():
+                    f.flush()
+
+
+def read_capture(path: str):
+    """Iterate over the records of a capture file (a truncated last record is ignored)"""
+    unpacker = msgpack.Unpacker(raw=False)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(64 * 1024)
+            if not chunk:
+                return
+            unpacker.feed(chunk)
+            for record in unpacker:
+                yield record
+
+
+class TrafficCaptureMiddleware:
+    """ASGI middleware handing the body, status and latency of captured requests to the recorder"""
+
+    def __init__(self, app, recorder: TrafficRecorder, paths=CAPTURED_PATHS):
+        self.app = app
+        self.recorder = recorder
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths or not self.recorder.should_capture():
+            await self.app(scope, receive, send)
+            return
+
+        chunks = []
+        size = 0
+        response_status = None
+
+        async def receive_and_copy():
+            nonlocal size
+            message = await receive()
+            if message["type"] == "http.request":
+                size += len(message.get("body", b""))
+                if size <= MAX_CAPTURED_BODY_BYTES:
+                    chunks.append(message.get("body", b""))
+            return message
+
+        async def send_and_observe(message):
+            nonlocal response_status
+            if message["type"] == "http.response.start":
+                response_status = message["status"]
+            await send(message)
+
+        ts = time.time()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive_and_copy, send_and_observe)
+        finally:
+            if chunks and size <= MAX_CAPTURED_BODY_BYTES:
+                self.recorder.record(ts, scope["path"], response_status or 500, (time.perf_counter() - start) * 1000, b"".join(chunks))